@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+Regression check and benchmark of ProblemParser over benchmarks/parser_corpus.
+
+Each corpus document `<name>.xml` has a golden `<name>.json` holding the
+expected `ProblemParser.get_content()` output. Documents with <optioninput>
+also have a golden `<name>.optioninput.json` holding the `options` / `correct`
+attributes `make_xml_compatible` synthesizes, which get_content() doesn't
+expose. Run it inside an edx-platform
+virtualenv (capa and xmodule are needed):
+
+    python benchmarks/bench_parser.py -n 200 --json parser.json
+    python benchmarks/bench_parser.py --baseline parser.json --threshold 0.2
+    python benchmarks/bench_parser.py --stream
+
+Reports per-document parse time and aggregate throughput. Exits with status 1
+when an output differs from its golden file or the golden file is missing, or,
+with --baseline, when a document got slower than the baseline by more than
+--threshold. After an intended output change, or for a new document, write the
+golden files with --update. With --stream
+every document is parsed in the streaming mode used for oversized problems.
+"""
+from __future__ import division, print_function, unicode_literals
+
+import argparse
+import glob
+import hashlib
+import io
+import json
+import os
+import sys
+import timeit
+from importlib import import_module
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CORPUS_DIR = os.path.join(ROOT, 'benchmarks', 'parser_corpus')
+
+
+def setup_django(stream=False):
+    from django.conf import settings
+    if not settings.configured:
+        # no caching: every get_content() parses
+        settings.configure(
+            PROBLEM_DATA_CACHE=None,
+            PROBLEM_DATA_LOCAL_CACHE_BYTES=0,
+            PROBLEM_DATA_STREAM_PARSE_MIN_SIZE=0 if stream else None,
+        )
+    import django
+    django.setup()
+    sys.path.insert(0, ROOT)
+    return import_module('edx-course-problem-data.parser')
+
+
+class CorpusKey(object):
+
+    def __init__(self, block_id):
+        self.block_id = block_id
+
+    def _to_string(self):
+        return 'Corpus+Parser+2026+type@problem+block@' + self.block_id
+
+
+class CorpusBlock(object):
+    """
+    The parts of a problem xblock ProblemParser reads.
+    """
+
+    class ScopeIds(object):
+        def __init__(self, usage_id):
+            self.usage_id = usage_id
+
+    class DefinitionLocator(object):
+        def __init__(self, definition_id):
+            self.definition_id = definition_id
+
+    def __init__(self, name, data):
+        self.scope_ids = CorpusBlock.ScopeIds(CorpusKey(name))
+        self.definition_locator = CorpusBlock.DefinitionLocator(hashlib.md5(data.encode('utf-8')).hexdigest()[:24])
+        self.data = data
+
+    @property
+    def problem_types(self):
+        # same as CapaDescriptor.problem_types
+        from capa import responsetypes
+        from lxml import etree
+
+        tree = etree.XML(self.data)
+        registered_tags = responsetypes.registry.registered_tags()
+        return {node.tag for node in tree.iter() if node.tag in registered_tags}
+
+
+def load_corpus(names=None):
+    corpus = []
+    for path in sorted(glob.glob(os.path.join(CORPUS_DIR, '*.xml'))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        if names and name not in names:
+            continue
+        with io.open(path, encoding='utf-8') as f:
+            corpus.append((name, f.read()))
+    return corpus
+
+
+def golden_path(name):
+    return os.path.join(CORPUS_DIR, name + '.json')
+
+
+def dump_json(data):
+    return json.dumps(data, indent=2, separators=(',', ': '), sort_keys=True, ensure_ascii=False) + '\n'
+
+
+def check_golden(name, output, update):
+    """
+    Compare `output` with the golden file; rewrite it instead with `update`.
+    Return the failure status, or None when they match.
+    """
+    text = dump_json(output)
+    path = golden_path(name)
+    if update:
+        with io.open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        return None
+    if not os.path.exists(path):
+        return 'MISSING GOLDEN {}'.format(os.path.basename(path))
+
+    with io.open(path, encoding='utf-8') as f:
+        expected = f.read()
+    if json.loads(text) != json.loads(expected):
+        return 'OUTPUT CHANGED {}'.format(os.path.basename(path))
+    return None
+
+
+def optioninput_output(problem_parser, block):
+    """
+    The attributes `make_xml_compatible` synthesizes from the <option> children
+    of each <optioninput>, or None for documents without one.
+    """
+    parser = problem_parser.ProblemParser(block)
+    parser.load()
+    optioninputs = parser.tree.findall('.//optioninput')
+    if not optioninputs:
+        return None
+    return [{'options': x.get('options'), 'correct': x.get('correct')} for x in optioninputs]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('names', nargs='*', help='corpus documents to run, default all')
+    parser.add_argument('-n', '--number', type=int, default=100, help='parses per document')
+    parser.add_argument('--update', action='store_true', help='rewrite the golden outputs')
+    parser.add_argument('--baseline', default=None, help='--json output of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown over the baseline')
+    parser.add_argument('--json', dest='json_path', default=None, help='also write the timings to this file')
+    parser.add_argument('--stream', action='store_true', help='parse every document with iterparse_problem')
+    args = parser.parse_args()
+
+    problem_parser = setup_django(args.stream)
+    corpus = load_corpus(args.names)
+
+    baseline = {}
+    if args.baseline:
+        with io.open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)['documents']
+
+    result = {'number': args.number, 'documents': {}}
+    failed = False
+    total_seconds = 0
+    total_bytes = 0
+
+    print('{:<28} {:>8} {:>10} {:>10}  {}'.format('document', 'bytes', 'ms', 'docs/s', 'status'))
+    for name, data in corpus:
+        block = CorpusBlock(name, data)
+
+        def parse():
+            return problem_parser.ProblemParser(block).get_content()
+
+        status = [check_golden(name, parse(), args.update)]
+        options = optioninput_output(problem_parser, block)
+        if options is not None:
+            status.append(check_golden(name + '.optioninput', options, args.update))
+        status = [s for s in status if s is not None]
+
+        seconds = timeit.timeit(parse, number=args.number)
+        ms = seconds / args.number * 1000
+        total_seconds += seconds
+        total_bytes += len(data.encode('utf-8')) * args.number
+
+        if name in baseline and ms > baseline[name]['ms'] * (1 + args.threshold):
+            status.append('SLOWER {:+.0%}'.format(ms / baseline[name]['ms'] - 1))
+
+        failed = failed or bool(status)
+        result['documents'][name] = {'ms': ms, 'bytes': len(data.encode('utf-8'))}
+        print('{:<28} {:>8} {:>10.3f} {:>10.0f}  {}'.format(
+            name, len(data.encode('utf-8')), ms, 1000 / ms, ', '.join(status) or 'ok'))
+
+    parses = len(corpus) * args.number
+    result['docs_per_second'] = parses / total_seconds if total_seconds else None
+    result['mb_per_second'] = total_bytes / total_seconds / 1e6 if total_seconds else None
+    print('aggregate: {} documents, {:.0f} docs/s, {:.2f} MB/s'.format(
+        len(corpus), result['docs_per_second'] or 0, result['mb_per_second'] or 0))
+
+    if args.json_path:
+        with io.open(args.json_path, 'w', encoding='utf-8') as f:
+            f.write(dump_json(result))
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark ProblemJSONRenderer against DRF's JSONRenderer.
+
+The payload should be real parser output, e.g. a saved response of
+`POST problems/detail` with 100 problems:
+
+    python benchmarks/bench_renderer.py detail.json -n 200
+
+Reports per-render time and body size for plain JSON and for each
+compression the renderer can produce. Exits with status 1 when a
+compression case doesn't return a compressed body.
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import gzip
+import io
+import json
+import os
+import sys
+import timeit
+from importlib import import_module
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_django():
+    from django.conf import settings
+    if not settings.configured:
+        settings.configure(PROBLEM_DATA_COMPRESS_MIN_BYTES=0)
+    import django
+    django.setup()
+    sys.path.insert(0, ROOT)
+    return import_module('edx-course-problem-data.renderers')
+
+
+class FakeRequest(object):
+
+    def __init__(self, accept_encoding):
+        self.META = {'HTTP_ACCEPT_ENCODING': accept_encoding}
+
+
+def make_context(renderer, accept_encoding=''):
+    """
+    Renderer context of a response negotiated to `renderer`, as DRF builds it;
+    the renderer only compresses its own response.
+    """
+    from rest_framework.response import Response
+
+    def context():
+        response = Response()
+        response.accepted_renderer = renderer
+        response.accepted_media_type = renderer.media_type
+        return {'request': FakeRequest(accept_encoding), 'response': response}
+    return context
+
+
+def decompress(encoding, body):
+    if encoding == 'gzip':
+        with gzip.GzipFile(fileobj=io.BytesIO(body)) as f:
+            return f.read()
+    if encoding == 'br':
+        import brotli
+        return brotli.decompress(body)
+    return body
+
+
+def bench(renderer, data, context, number, encoding=None):
+    """
+    Return the per-render ms and body size, checking the body is `encoding` compressed.
+    """
+    ctx = context()
+    body = renderer.render(data, 'application/json', ctx)
+    if ctx['response'].get('Content-Encoding') != encoding:
+        raise ValueError('expected Content-Encoding {}, got {}'.format(
+            encoding, ctx['response'].get('Content-Encoding')))
+    json.loads(decompress(encoding, body).decode('utf-8'))
+
+    seconds = timeit.timeit(lambda: renderer.render(data, 'application/json', context()), number=number)
+    return seconds / number * 1000, len(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('payload', help='JSON file with parser output')
+    parser.add_argument('-n', '--number', type=int, default=100, help='renders per case')
+    args = parser.parse_args()
+
+    renderers = setup_django()
+    from rest_framework.renderers import JSONRenderer
+
+    with io.open(args.payload, encoding='utf-8') as f:
+        data = json.load(f)
+
+    # (name, renderer, Accept-Encoding, expected Content-Encoding)
+    cases = [
+        ('JSONRenderer', JSONRenderer(), '', None),
+        ('ProblemJSONRenderer', renderers.ProblemJSONRenderer(), '', None),
+        ('ProblemJSONRenderer gzip', renderers.ProblemJSONRenderer(), 'gzip', 'gzip'),
+    ]
+    if renderers.brotli is not None:
+        cases.append(('ProblemJSONRenderer br', renderers.ProblemJSONRenderer(), 'br', 'br'))
+
+    encoder = getattr(renderers.fast_json, '__name__', 'json (DRF)')
+    print('encoder: {}, renders per case: {}'.format(encoder, args.number))
+    print('{:<28} {:>10} {:>12}'.format('case', 'ms', 'bytes'))
+    baseline = None
+    for name, renderer, accept_encoding, encoding in cases:
+        try:
+            ms, size = bench(renderer, data, make_context(renderer, accept_encoding), args.number, encoding)
+        except ValueError as ex:
+            print('{:<28} {}'.format(name, ex))
+            sys.exit(1)
+        baseline = baseline or ms
+        print('{:<28} {:>10.3f} {:>12} {:>7.2f}x'.format(name, ms, size, baseline / ms))
+
+
+if __name__ == '__main__':
+    main()
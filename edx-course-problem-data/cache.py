@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+"""
+两级缓存：进程内 LRU + Django cache（memcached / Redis）
+
+* 值以紧凑的二进制格式存储（有 msgpack 时用 msgpack，否则退回 json），
+  超过阈值的值再用 zlib 压缩
+* key 按 namespace 和版本（structure / definition version）划分，
+  版本不变内容就不变，所以不需要主动失效
+* 进程内 LRU 按字节数淘汰
+* 每一级的命中率通过 stats() 暴露给监控
+
+另有 NegativeCache，在进程内记住一段时间内已知无效的 block id；
+RuntimeCache，按 structure 版本缓存 modulestore 的 runtime，按数量和估算的字节数淘汰。
+
+Settings:
+    PROBLEM_DATA_CACHE               共享缓存使用的 cache 别名，None 表示只用进程内缓存
+    PROBLEM_DATA_CACHE_TIMEOUT       共享缓存的过期秒数
+    PROBLEM_DATA_LOCAL_CACHE_BYTES   每个进程内 LRU 的最大字节数
+    PROBLEM_DATA_CACHE_COMPRESS_MIN  超过该字节数的值使用 zlib 压缩
+
+NegativeCache 的大小和过期时间见 models.invalid_blocks，RuntimeCache 的上限见 models.runtime_cache。
+"""
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import logging
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from django.conf import settings
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+log = logging.getLogger("mongo.api")
+
+# 编码格式标记，写在值的第一个字节
+FORMAT_JSON = b'j'
+FORMAT_MSGPACK = b'm'
+FORMAT_ZLIB = b'z'
+
+_caches = []
+
+
+def encode(value, compress_min=1024):
+    """
+    Serialize `value` to bytes, compressing it when larger than `compress_min`.
+    """
+    if msgpack is not None:
+        data = FORMAT_MSGPACK + msgpack.packb(value, use_bin_type=True)
+    else:
+        data = FORMAT_JSON + json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+    if compress_min is not None and len(data) > compress_min:
+        data = FORMAT_ZLIB + zlib.compress(data)
+    return data
+
+
+def decode(data):
+    """
+    Inverse of `encode`.
+    """
+    fmt, payload = data[:1], data[1:]
+    if fmt == FORMAT_ZLIB:
+        return decode(zlib.decompress(payload))
+    if fmt == FORMAT_MSGPACK:
+        try:
+            return msgpack.unpackb(payload, raw=False)
+        except TypeError:
+            # msgpack < 0.5.2
+            return msgpack.unpackb(payload, encoding='utf-8')
+    if fmt == FORMAT_JSON:
+        return json.loads(payload.decode('utf-8'))
+    raise ValueError("Unknown cache value format: {!r}".format(fmt))
+
+
+class LRUCache(object):
+    """
+    In-process LRU of encoded values, evicted by total size in bytes and,
+    optionally, by number of entries.
+    """
+
+    def __init__(self, max_bytes, max_entries=None):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.bytes = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.pop(key, None)
+            if value is not None:
+                self._data[key] = value
+            return value
+
+    def set(self, key, value, size=None):
+        """
+        Store `value`, which takes `size` bytes, by default `len(value)`.
+        """
+        if size is None:
+            size = len(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self.bytes -= self._sizes.pop(key)
+            self._data[key] = value
+            self._sizes[key] = size
+            self.bytes += size
+            while self.bytes > self.max_bytes or (self.max_entries and len(self._data) > self.max_entries):
+                evicted, _ = self._data.popitem(last=False)
+                self.bytes -= self._sizes.pop(evicted)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self.bytes -= self._sizes.pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.bytes = 0
+
+
+class TwoTierCache(object):
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.local = LRUCache(getattr(settings, 'PROBLEM_DATA_LOCAL_CACHE_BYTES', 32 * 1024 * 1024))
+        self.counters = {
+            'local_hits': 0,
+            'local_misses': 0,
+            'shared_hits': 0,
+            'shared_misses': 0,
+        }
+        _caches.append(self)
+
+    def get_shared(self):
+        alias = getattr(settings, 'PROBLEM_DATA_CACHE', 'default')
+        if alias is None:
+            return None
+        from django.core.cache import caches
+        return caches[alias]
+
+    def make_key(self, key, version):
+        digest = hashlib.md5(key.encode('utf-8')).hexdigest()
+        return 'problem_data:{}:{}:{}'.format(self.namespace, version, digest)
+
+    def get(self, key, version, default=None):
+        """
+        Return the cached value for `key` at `version`, or `default`.
+        """
+        cache_key = self.make_key(key, version)
+
+        data = self.local.get(cache_key)
+        if data is not None:
+            self.counters['local_hits'] += 1
+            return decode(data)
+        self.counters['local_misses'] += 1
+
+        shared = self.get_shared()
+        if shared is None:
+            return default
+
+        data = shared.get(cache_key)
+        if data is None:
+            self.counters['shared_misses'] += 1
+            return default
+        self.counters['shared_hits'] += 1
+
+        self.local.set(cache_key, data)
+        return decode(data)
+
+    def set(self, key, version, value):
+        cache_key = self.make_key(key, version)
+        data = encode(value, getattr(settings, 'PROBLEM_DATA_CACHE_COMPRESS_MIN', 1024))
+
+        self.local.set(cache_key, data)
+
+        shared = self.get_shared()
+        if shared is not None:
+            shared.set(cache_key, data, getattr(settings, 'PROBLEM_DATA_CACHE_TIMEOUT', 24 * 60 * 60))
+
+    def stats(self):
+        counters = self.counters
+
+        def ratio(hits, misses):
+            total = hits + misses
+            return float(hits) / total if total else None
+
+        return {
+            'namespace': self.namespace,
+            'local': {
+                'hits': counters['local_hits'],
+                'misses': counters['local_misses'],
+                'hit_ratio': ratio(counters['local_hits'], counters['local_misses']),
+                'entries': len(self.local),
+                'bytes': self.local.bytes,
+                'max_bytes': self.local.max_bytes,
+            },
+            'shared': {
+                'hits': counters['shared_hits'],
+                'misses': counters['shared_misses'],
+                'hit_ratio': ratio(counters['shared_hits'], counters['shared_misses']),
+            },
+        }
+
+
+class RuntimeCache(LRUCache):
+    """
+    In-process LRU of modulestore runtimes by structure version, evicted by
+    number of runtimes and their approximate size.
+    """
+
+    def __init__(self, namespace, max_entries, max_bytes):
+        super(RuntimeCache, self).__init__(max_bytes, max_entries)
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+        _caches.append(self)
+
+    def get(self, key):
+        value = super(RuntimeCache, self).get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'namespace': self.namespace,
+            'local': {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': float(self.hits) / total if total else None,
+                'entries': len(self),
+                'max_entries': self.max_entries,
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'evictions': self.evictions,
+            },
+        }
+
+
+class NegativeCache(object):
+    """
+    Bounded in-process set of keys known to be invalid, each kept for `timeout`
+    seconds. Keys can be tagged with a course so that a publish drops them.
+    """
+
+    def __init__(self, namespace, max_entries, timeout):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        _caches.append(self)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] < time.time():
+                del self._data[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return False
+            self.hits += 1
+            return True
+
+    def add(self, key, course=None):
+        if not self.max_entries:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + self.timeout, course)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self, course=None):
+        """
+        Drop the keys tagged with `course`, or every key.
+        """
+        with self._lock:
+            if course is None:
+                self._data.clear()
+                return
+            for key in [k for k, (_, c) in self._data.items() if c == course]:
+                del self._data[key]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'namespace': self.namespace,
+            'local': {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': float(self.hits) / total if total else None,
+                'entries': len(self._data),
+                'max_entries': self.max_entries,
+            },
+        }
+
+
+def stats():
+    """
+    Stats of every cache in this process, for monitoring.
+    """
+    return [c.stats() for c in _caches]
@@ -5,4 +5,16 @@ class NotSupportType(Exception):
     pass
 
 class GetItemError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+class InvalidBlockError(GetItemError):
+    """
+    Raised when a block id can't be parsed or the block doesn't exist.
+    """
+    pass
+
+class InvalidCursorError(Exception):
+    """
+    Raised when a pagination cursor is malformed or was issued for another structure version.
+    """
+    pass
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+跨节点的缓存失效广播
+
+课程发布时，发布所在的进程把 (课程, 新的 structure 版本) 广播给所有节点，
+各节点只清除该课程受影响的进程内缓存（目前是 models.invalid_blocks），
+不必靠很短的过期时间来保证一致。
+
+按版本缓存的内容（题目索引、解析结果、runtime、快照）不会过期，不需要失效。
+
+后端：
+* local  只在本进程内生效，用于测试和单机部署
+* redis  Redis pub/sub channel，需要 `pip install redis`
+* db     数据库中的变更日志表（InvalidationEvent），各节点轮询
+
+各节点在处理请求前调用 poll()，每 PROBLEM_DATA_INVALIDATION_POLL_INTERVAL 秒最多读取一次，
+不需要后台线程。与 Redis 的连接断开时可能丢失消息，此时清除全部课程的记录。
+
+Settings:
+    PROBLEM_DATA_INVALIDATION_BACKEND        'local'、'redis' 或 'db'
+    PROBLEM_DATA_INVALIDATION_REDIS_URL      redis 后端的连接地址
+    PROBLEM_DATA_INVALIDATION_CHANNEL        redis 后端的 channel 名
+    PROBLEM_DATA_INVALIDATION_POLL_INTERVAL  两次读取之间的最短秒数
+    PROBLEM_DATA_INVALIDATION_RETENTION      db 后端变更日志保留的秒数
+"""
+from __future__ import unicode_literals
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+log = logging.getLogger("mongo.api")
+
+# 收到 course_id 为 None 的消息时清除全部课程
+ALL_COURSES = None
+
+_subscribers = []
+
+
+def subscribe(fn):
+    """
+    Register `fn(course_id, version)` to be called on every node when a course
+    is published. `course_id` is None when every course may be affected.
+    """
+    _subscribers.append(fn)
+    return fn
+
+
+def notify(course_id, version):
+    for fn in list(_subscribers):
+        try:
+            fn(course_id, version)
+        except Exception:
+            log.exception("invalidation of %s failed", course_id)
+
+
+class LocalBackend(object):
+    """
+    In-memory channel. Buses whose backends share `messages` act as nodes of
+    one deployment, which is enough for tests.
+    """
+
+    def __init__(self, messages=None):
+        self.messages = messages if messages is not None else []
+        self._position = len(self.messages)
+
+    def send(self, message):
+        self.messages.append(message)
+
+    def receive(self):
+        messages = self.messages[self._position:]
+        self._position += len(messages)
+        return messages
+
+
+class RedisBackend(object):
+    """
+    Redis pub/sub channel. Each process subscribes on first use, after any fork.
+    """
+
+    def __init__(self, url, channel):
+        if redis is None:
+            raise ImportError("The redis invalidation backend needs the redis package")
+        self.url = url
+        self.channel = channel
+        self._client = None
+        self._pubsub = None
+        self._pid = None
+
+    def connect(self):
+        if self._pid != os.getpid() or self._pubsub is None:
+            self._client = redis.StrictRedis.from_url(self.url)
+            self._pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+            self._pubsub.subscribe(self.channel)
+            self._pid = os.getpid()
+
+    def send(self, message):
+        self.connect()
+        self._client.publish(self.channel, json.dumps(message))
+
+    def receive(self):
+        try:
+            self.connect()
+            messages = []
+            while True:
+                item = self._pubsub.get_message()
+                if item is None:
+                    break
+                if item['type'] == 'message':
+                    data = item['data']
+                    messages.append(json.loads(data.decode('utf-8') if isinstance(data, bytes) else data))
+            return messages
+        except redis.RedisError as ex:
+            # 断开期间的消息已经丢失
+            log.warning("invalidation channel lost: %s", ex)
+            self._pubsub = None
+            return [{'course_id': ALL_COURSES, 'version': None, 'origin': None}]
+
+
+class DatabaseBackend(object):
+    """
+    Change-log table polled by every node. Rows older than `retention` seconds
+    are deleted on each publish.
+    """
+
+    def __init__(self, retention):
+        self.retention = retention
+        self._last_id = None
+
+    def send(self, message):
+        from django.utils import timezone
+        from .models import InvalidationEvent
+
+        InvalidationEvent.objects.create(
+            course_id=message['course_id'],
+            version=message['version'] or '',
+            origin=message['origin'],
+        )
+        InvalidationEvent.objects.filter(created__lt=timezone.now() - timedelta(seconds=self.retention)).delete()
+
+    def receive(self):
+        from django.db.models import Max
+        from .models import InvalidationEvent
+
+        if self._last_id is None:
+            # 之前的发布与本进程尚未缓存的内容无关
+            self._last_id = InvalidationEvent.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+            return []
+
+        rows = InvalidationEvent.objects.filter(id__gt=self._last_id).order_by('id').values_list(
+            'id', 'course_id', 'version', 'origin')
+        messages = []
+        for event_id, course_id, version, origin in rows:
+            self._last_id = event_id
+            messages.append({'course_id': course_id, 'version': version or None, 'origin': origin})
+        return messages
+
+
+class InvalidationBus(object):
+    """
+    Broadcasts publish events through `backend` and hands the events of other
+    nodes to the subscribers.
+    """
+
+    def __init__(self, backend, poll_interval=0, on_message=notify):
+        self.backend = backend
+        self.poll_interval = poll_interval
+        self.on_message = on_message
+        self._node = None
+        self._next_poll = 0
+        self._lock = threading.Lock()
+
+    @property
+    def node(self):
+        """
+        Id of this process, renewed after a fork.
+        """
+        if self._node is None or self._node[0] != os.getpid():
+            self._node = (os.getpid(), '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8]))
+        return self._node[1]
+
+    def publish(self, course_id, version):
+        """
+        Invalidate `course_id` in this process right away and on the other nodes.
+        """
+        self.on_message(course_id, version)
+        try:
+            self.backend.send({'course_id': course_id, 'version': version, 'origin': self.node})
+        except Exception:
+            log.exception("broadcast of %s@%s failed", course_id, version)
+
+    def poll(self, force=False):
+        """
+        Apply the events published by other nodes since the last poll.
+        """
+        now = time.time()
+        if not force and now < self._next_poll:
+            return
+        # 同一时刻只需要一个线程读取
+        if not self._lock.acquire(False):
+            return
+        try:
+            self._next_poll = now + self.poll_interval
+            messages = self.backend.receive()
+        except Exception:
+            log.exception("invalidation poll failed")
+            return
+        finally:
+            self._lock.release()
+
+        for message in messages:
+            if message['origin'] is not None and message['origin'] == self.node:
+                continue
+            log.info("invalidate %s@%s from %s", message['course_id'], message['version'], message['origin'])
+            self.on_message(message['course_id'], message['version'])
+
+
+def create_backend():
+    name = getattr(settings, 'PROBLEM_DATA_INVALIDATION_BACKEND', 'local')
+    if name == 'redis':
+        return RedisBackend(
+            getattr(settings, 'PROBLEM_DATA_INVALIDATION_REDIS_URL', 'redis://localhost:6379/0'),
+            getattr(settings, 'PROBLEM_DATA_INVALIDATION_CHANNEL', 'problem_data.invalidation'),
+        )
+    if name == 'db':
+        return DatabaseBackend(getattr(settings, 'PROBLEM_DATA_INVALIDATION_RETENTION', 24 * 60 * 60))
+    if name == 'local':
+        return LocalBackend()
+    raise ValueError("Unknown invalidation backend: {!r}".format(name))
+
+
+_bus = None
+_bus_lock = threading.Lock()
+
+
+def get_bus():
+    global _bus
+    if _bus is None:
+        with _bus_lock:
+            if _bus is None:
+                _bus = InvalidationBus(
+                    create_backend(),
+                    getattr(settings, 'PROBLEM_DATA_INVALIDATION_POLL_INTERVAL', 1),
+                )
+    return _bus
+
+
+def publish(course_id, version):
+    get_bus().publish(course_id, version)
+
+
+def poll():
+    get_bus().poll()
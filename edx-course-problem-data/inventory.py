@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+全部在开课程的题目统计
+
+由 `build_problem_inventory` 命令在后台生成（多进程，每个进程处理一部分课程），
+结果连同生成时间写到 PROBLEM_DATA_INVENTORY_PATH，接口只读取该文件。
+
+Settings:
+    PROBLEM_DATA_INVENTORY_PATH  统计结果文件路径，默认 DATA_DIR/problem_inventory.json
+"""
+from __future__ import unicode_literals
+
+import datetime
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+from multiprocessing import Pool
+
+import six
+from django.conf import settings
+
+log = logging.getLogger("exam.api")
+
+PROBLEM_TYPES = ["multiplechoiceresponse", "choiceresponse", "stringresponse"]
+
+_loaded = {'mtime': None, 'data': None}
+_lock = threading.Lock()
+
+
+def get_inventory_path():
+    default = os.path.join(getattr(settings, 'DATA_DIR', tempfile.gettempdir()), 'problem_inventory.json')
+    return getattr(settings, 'PROBLEM_DATA_INVENTORY_PATH', default)
+
+
+def active_course_ids():
+    from openedx.core.djangoapps.content.course_overviews.models import CourseOverview
+
+    today = datetime.date.today()
+    queryset = CourseOverview.objects.filter(start__lte=today, end__gte=today).order_by('display_name')
+    return [six.text_type(course_id) for course_id in queryset.values_list('id', flat=True)]
+
+
+def count_problem_types(xblocks):
+    """
+    Count the problems among `xblocks` that have exactly one of PROBLEM_TYPES.
+    Reads only `problem_types`, not the `multi` flag of the problem index.
+    """
+    counts = dict((ptype, 0) for ptype in PROBLEM_TYPES)
+    for x in xblocks:
+        if x.scope_ids.block_type != 'problem':
+            continue
+        problem_types = getattr(x, 'problem_types', None) or set()
+        if len(problem_types) == 1:
+            ptype = list(problem_types)[0]
+            if ptype in counts:
+                counts[ptype] += 1
+    return counts
+
+
+def build_course_inventory(course_id):
+    """
+    Problem counts of one course and of each of its chapters.
+    """
+    from .models import BlockStructure, traverse
+
+    try:
+        course = BlockStructure(course_id)
+        # 整个课程的题目定义一次批量读取，不再每道题查询一次
+        course.prefetch_definitions()
+        chapters = []
+        for chapter in course.xblock.get_children():
+            chapters.append({
+                'id': chapter.scope_ids.usage_id._to_string(),
+                'name': chapter.display_name,
+                'counts': count_problem_types(traverse(chapter)),
+            })
+
+        counts = dict((ptype, sum(c['counts'][ptype] for c in chapters)) for ptype in PROBLEM_TYPES)
+        return {
+            'id': course_id,
+            'name': course.xblock.display_name,
+            'counts': counts,
+            'chapters': chapters,
+        }
+    except Exception as ex:
+        log.error("problem inventory of %s failed: %s", course_id, ex)
+        return {'id': course_id, 'error': six.text_type(ex)}
+
+
+def build_inventory(course_ids, processes=None):
+    """
+    Build the inventory of `course_ids` over a pool of `processes` worker processes.
+    """
+    from django.db import connections
+
+    # 子进程不能共用父进程的数据库连接
+    connections.close_all()
+
+    pool = Pool(processes)
+    try:
+        courses = pool.map(build_course_inventory, course_ids, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    return {
+        'generated_at': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'courses': courses,
+    }
+
+
+def save_inventory(data, path=None):
+    """
+    Atomically replace the stored inventory.
+    """
+    path = path or get_inventory_path()
+    directory = os.path.dirname(path) or '.'
+    fd, tmp = tempfile.mkstemp(prefix='.problem_inventory', dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(json.dumps(data).encode('utf-8'))
+    os.chmod(tmp, 0o644)
+    os.rename(tmp, path)
+
+
+def load_inventory():
+    """
+    Return the stored inventory, or None when it has not been built yet.
+    Re-read only when the file changes.
+    """
+    path = get_inventory_path()
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+
+    with _lock:
+        if _loaded['mtime'] != mtime:
+            with io.open(path, encoding='utf-8') as f:
+                _loaded['data'] = json.load(f)
+            _loaded['mtime'] = mtime
+        return _loaded['data']
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+把在开课程当前发布版本的题目解析结果写入归档（ProblemArchive），
+之后指定该版本的 `problems/detail` 请求直接读取归档，不再访问 modulestore。
+
+课程发布后执行即可，已归档的版本会跳过：
+
+    ./manage.py cms archive_problem_versions
+"""
+from __future__ import unicode_literals
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from ... import inventory
+from ...models import BlockStructure, ProblemArchive
+from ...parser import ProblemParser
+
+
+class Command(BaseCommand):
+    help = "Archive the parsed content of the published problems of active courses."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--course', action='append', dest='courses', default=None,
+                            help="only these course ids, may be repeated")
+
+    def archive_course(self, course_id):
+        archived = 0
+        for xblock in BlockStructure(course_id).get_xblocks(prefetch=True):
+            if xblock.scope_ids.block_type != 'problem' or not getattr(xblock, 'problem_types', None):
+                continue
+
+            usage_id = xblock.scope_ids.usage_id._to_string()
+            version = str(xblock.definition_locator.definition_id)
+            if ProblemArchive.objects.filter(usage_id=usage_id, definition_version=version).exists():
+                continue
+
+            try:
+                data = ProblemParser(xblock).get_content()
+            except Exception as ex:
+                self.stderr.write("{}: {}".format(usage_id, ex))
+                continue
+            if ProblemArchive.archive(usage_id, version, data):
+                archived += 1
+        return archived
+
+    def handle(self, *args, **options):
+        course_ids = options['courses'] or inventory.active_course_ids()
+
+        start = time.time()
+        total = 0
+        for course_id in course_ids:
+            try:
+                archived = self.archive_course(course_id)
+            except Exception as ex:
+                self.stderr.write("{}: {}".format(course_id, ex))
+                continue
+            total += archived
+            self.stdout.write("{}: {} problems archived".format(course_id, archived))
+
+        self.stdout.write("{} courses, {} problems archived, {:.1f}s".format(len(course_ids), total, time.time() - start))
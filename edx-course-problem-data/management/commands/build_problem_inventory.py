@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+生成全部在开课程的题目统计，供 `problems/inventory` 接口读取。
+
+建议用 cron 定时执行：
+
+    ./manage.py cms build_problem_inventory --processes 8
+"""
+from __future__ import unicode_literals
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from ... import inventory
+
+
+class Command(BaseCommand):
+    help = "Build per-course and per-chapter problem counts of all active courses."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=None,
+                            help="worker processes, defaults to the number of CPUs")
+        parser.add_argument('--course', action='append', dest='courses', default=None,
+                            help="only these course ids, may be repeated")
+
+    def handle(self, *args, **options):
+        course_ids = options['courses'] or inventory.active_course_ids()
+
+        start = time.time()
+        data = inventory.build_inventory(course_ids, options['processes'])
+        inventory.save_inventory(data)
+
+        failed = len([c for c in data['courses'] if 'error' in c])
+        self.stdout.write("{} courses, {} failed, {:.1f}s -> {}".format(
+            len(course_ids), failed, time.time() - start, inventory.get_inventory_path()
+        ))
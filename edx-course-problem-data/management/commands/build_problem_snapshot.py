@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+生成在开课程当前发布版本的题目快照，写到 PROBLEM_DATA_SNAPSHOT_DIR。
+
+课程发布后重新执行即可，已有的版本会跳过：
+
+    ./manage.py cms build_problem_snapshot --keep 2
+"""
+from __future__ import unicode_literals
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import inventory, snapshot
+
+
+class Command(BaseCommand):
+    help = "Build the problem snapshot of the published version of active courses."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--course', action='append', dest='courses', default=None,
+                            help="only these course ids, may be repeated")
+        parser.add_argument('--keep', type=int, default=2,
+                            help="snapshots to keep per course, including the new one")
+
+    def handle(self, *args, **options):
+        if snapshot.get_snapshot_dir() is None:
+            raise CommandError("PROBLEM_DATA_SNAPSHOT_DIR is not set.")
+
+        course_ids = options['courses'] or inventory.active_course_ids()
+
+        start = time.time()
+        failed = 0
+        for course_id in course_ids:
+            try:
+                path = snapshot.build_snapshot(course_id)
+            except Exception as ex:
+                failed += 1
+                self.stderr.write("{}: {}".format(course_id, ex))
+                continue
+
+            if path is None:
+                self.stdout.write("{}: no structure version, skipped".format(course_id))
+                continue
+            snapshot.remove_old_snapshots(path, options['keep'])
+            self.stdout.write("{} -> {}".format(course_id, path))
+
+        self.stdout.write("{} courses, {} failed, {:.1f}s".format(len(course_ids), failed, time.time() - start))
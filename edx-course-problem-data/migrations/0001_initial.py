@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProblemArchive',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('usage_id', models.CharField(max_length=200)),
+                ('definition_version', models.CharField(max_length=24)),
+                ('content', models.BinaryField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'db_table': 'problem_data_archive',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='problemarchive',
+            unique_together=set([('usage_id', 'definition_version')]),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('edx-course-problem-data', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InvalidationEvent',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('course_id', models.CharField(max_length=255)),
+                ('version', models.CharField(max_length=24, blank=True)),
+                ('origin', models.CharField(max_length=100)),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'db_table': 'problem_data_invalidation',
+            },
+        ),
+    ]
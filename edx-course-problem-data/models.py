@@ -1,18 +1,239 @@
 import logging
+import threading
 from collections import deque
+from contextlib import contextmanager
+
+import six
+from lxml import etree
+from django.conf import settings
+from django.db import IntegrityError, models, transaction
+from django.dispatch import receiver
 
 from opaque_keys.edx.keys import CourseKey, UsageKey
-from opaque_keys.edx.locator import BlockUsageLocator, InvalidKeyError
-from xmodule.modulestore.django import modulestore
+from opaque_keys.edx.locator import BlockUsageLocator, DefinitionLocator, InvalidKeyError
+from xblock.fields import ScopeIds
+from xmodule.modulestore import ModuleStoreEnum
+from xmodule.modulestore.django import SignalHandler, modulestore
+from xmodule.modulestore.exceptions import ItemNotFoundError
 from bson.objectid import ObjectId
 from bson.errors import InvalidId
 from xmodule.modulestore.split_mongo.split_draft import DraftVersioningModuleStore
 from xmodule.modulestore.split_mongo import BlockKey, CourseEnvelope
 
-from .exceptions import GetItemError
+from . import invalidation, profiling, snapshot
+from .cache import NegativeCache, RuntimeCache, TwoTierCache, decode, encode
+from .exceptions import GetItemError, InvalidBlockError
+from .parser import ProblemParser, registry
+from .singleflight import SingleFlight
 
 log = logging.getLogger("mongo.api")
 
+# deduplicates concurrent loads of the same (block, version)
+_single_flight = SingleFlight()
+
+# problem index of a subtree, keyed by structure version
+index_cache = TwoTierCache('index')
+
+# (block id, version) pairs known to be invalid. Cleared on every node when the
+# course is published, see `invalidation`; entries also expire after the timeout.
+invalid_blocks = NegativeCache(
+    'invalid_blocks',
+    getattr(settings, 'PROBLEM_DATA_NEGATIVE_CACHE_SIZE', 10000),
+    getattr(settings, 'PROBLEM_DATA_NEGATIVE_CACHE_TIMEOUT', 60),
+)
+
+# runtimes of pinned structure versions, see `BlockStructure._get_version_xblock`.
+# Each worker process holds its own; the runtimes are shared by its threads.
+runtime_cache = RuntimeCache(
+    'runtimes',
+    getattr(settings, 'PROBLEM_DATA_RUNTIME_CACHE_SIZE', 8),
+    getattr(settings, 'PROBLEM_DATA_RUNTIME_CACHE_BYTES', 64 * 1024 * 1024),
+)
+
+# rough size of an xblock built by a runtime, with its field data
+XBLOCK_BYTES = 4 * 1024
+
+# blocks loaded inside the current `request_scope`
+_request_scope = threading.local()
+
+
+@contextmanager
+def request_scope():
+    """
+    Share loaded blocks between the BlockStructures created inside the block,
+    so that a course and its sections are only loaded from the modulestore once.
+    Nested scopes share the outermost one.
+    """
+    if getattr(_request_scope, 'xblocks', None) is not None:
+        yield
+        return
+
+    _request_scope.xblocks = {}
+    try:
+        yield
+    finally:
+        _request_scope.xblocks = None
+
+
+def propagate_scope(fn):
+    """
+    Wrap `fn` to run in a worker thread, sharing the calling thread's `request_scope`.
+    """
+    xblocks = getattr(_request_scope, 'xblocks', None)
+    if xblocks is None:
+        return fn
+
+    def wrapper(*args, **kwargs):
+        _request_scope.xblocks = xblocks
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _request_scope.xblocks = None
+
+    return wrapper
+
+
+def release_runtimes():
+    """
+    Drop the runtimes split-mongo keeps in the current thread's request cache.
+    The platform's request cache middleware does this for request threads;
+    worker threads call it when their task is done.
+    """
+    for s in getattr(modulestore(), 'modulestores', []):
+        request_cache = getattr(s, 'request_cache', None)
+        if request_cache is not None:
+            request_cache.data.pop('course_cache', None)
+
+
+class RuntimeGuard(object):
+    """
+    Lock of a split runtime shared between threads, e.g. one in `runtime_cache`.
+
+    `module_data` and the blocks a runtime builds are not thread-safe, so its
+    `load_item`, through which `get_block` and `get_children` load blocks too,
+    and the `cache_items` of this module run under the lock. The blocks loaded
+    are recorded so that their xblocks count in `estimate_runtime_bytes`.
+    """
+
+    def __init__(self, runtime):
+        self.lock = threading.RLock()
+        self.loaded = set()
+        self.estimated = None
+        load_item = runtime.load_item
+
+        def locked_load_item(block_key, *args, **kwargs):
+            with self.lock:
+                self.loaded.add(block_key)
+                return load_item(block_key, *args, **kwargs)
+
+        runtime.load_item = locked_load_item
+
+
+def guard_runtime(runtime):
+    """
+    The `RuntimeGuard` of `runtime`, created on first use.
+    """
+    guard = getattr(runtime, 'problem_data_guard', None)
+    if guard is None:
+        guard = runtime.problem_data_guard = RuntimeGuard(runtime)
+    return guard
+
+
+def estimate_runtime_bytes(runtime):
+    """
+    Rough size of the blocks and definitions a split runtime holds: a fixed
+    overhead per block plus its string fields, mostly the problem XML, and the
+    xblocks it has built.
+    """
+    guard = guard_runtime(runtime)
+    with guard.lock:
+        size = len(guard.loaded) * XBLOCK_BYTES
+        for data in list(runtime.module_data.values()):
+            size += 1024
+            fields = data.get('fields') if isinstance(data, dict) else getattr(data, 'fields', None)
+            for value in (fields or {}).values():
+                if isinstance(value, six.string_types):
+                    size += len(value)
+        guard.estimated = (len(runtime.module_data), len(guard.loaded))
+    return size
+
+
+def update_runtime_size(cache_key, cached):
+    """
+    Re-estimate the size of the cached runtime `cached` if it loaded blocks or
+    definitions since its last estimate.
+    """
+    runtime = cached[0]
+    guard = guard_runtime(runtime)
+    if guard.estimated != (len(runtime.module_data), len(guard.loaded)):
+        runtime_cache.set(cache_key, cached, estimate_runtime_bytes(runtime))
+
+
+def get_structure_version(xblock):
+    """
+    Return the split-mongo structure id the xblock was loaded from, or None
+    when it is unknown (e.g. old mongo courses).
+    """
+    course_entry = getattr(getattr(xblock, 'runtime', None), 'course_entry', None)
+    if course_entry is None:
+        return None
+    return six.text_type(course_entry.structure['_id'])
+
+
+def get_course_id(course_key):
+    """
+    Course id without branch and version, as used to tag `invalid_blocks`.
+    """
+    return six.text_type(course_key.replace(branch=None, version_guid=None))
+
+
+def get_published_version(course_key):
+    """
+    Structure version of the published branch of the course, or None.
+    """
+    store = modulestore()
+    try:
+        with store.branch_setting(ModuleStoreEnum.Branch.published_only, course_key):
+            course = store.get_course(course_key, depth=0)
+    except Exception as ex:
+        log.warning("published version of %s: %s", course_key, ex)
+        return None
+    return get_structure_version(course) if course is not None else None
+
+
+def traverse(xblock):
+    """
+    Yield `xblock` and its descendants, breadth first.
+    """
+    helperList = deque([xblock])
+
+    while len(helperList) > 0:
+        tempElement = helperList.popleft()
+        if tempElement is not None:
+            profiling.incr('xblocks_loaded')
+            yield tempElement
+            if hasattr(tempElement, "get_children"):
+                helperList.extend(tempElement.get_children())
+
+
+def build_problem_index(xblocks):
+    """
+    Describe the problems among `xblocks`, see `BlockStructure.get_problem_index`.
+    """
+    index = []
+    for x in xblocks:
+        if x.scope_ids.block_type != 'problem':
+            continue
+        problem_types = getattr(x, 'problem_types', None) or set()
+        index.append({
+            'id': x.scope_ids.usage_id._to_string(),
+            'def_id': six.text_type(x.scope_ids.def_id),
+            'version': six.text_type(x.definition_locator.definition_id),
+            'problem_types': sorted(problem_types),
+            'multi': bool(problem_types) and ProblemParser.has_multi_problem(x),
+        })
+    return index
+
 
 class BlockStructure(object):
 
@@ -23,15 +244,29 @@ class BlockStructure(object):
         self.xblock = None
         self.xblocks = None
 
-        self._get_usage_key()
-        self._get_xblock()
+        key = (block_id_string, six.text_type(version_guid or ''))
+        invalidation.poll()
+        if key in invalid_blocks:
+            profiling.incr('invalid_block_hits')
+            raise InvalidBlockError(block_id_string)
+
+        try:
+            self._get_usage_key()
+            self._get_xblock()
+        except InvalidBlockError:
+            course = get_course_id(self.usage_key.course_key) if self.usage_key is not None else None
+            invalid_blocks.add(key, course)
+            raise
 
     def _get_usage_key(self):
         try:
             block_id = 'block-v1:' + self.block_id_string
             self.usage_key = UsageKey.from_string(block_id)
         except InvalidKeyError:
-            course_key = CourseKey.from_string(self.block_id_string)
+            try:
+                course_key = CourseKey.from_string(self.block_id_string)
+            except InvalidKeyError:
+                raise InvalidBlockError(self.block_id_string)
             pattern = u"{course_key}+{BLOCK_TYPE_PREFIX}@{block_type}+{BLOCK_PREFIX}@{block_id}"
             block_id = pattern.format(
                 course_key=course_key._to_string(),
@@ -51,15 +286,36 @@ class BlockStructure(object):
         except InvalidId:
             version_guid = None
 
+        scope = getattr(_request_scope, 'xblocks', None)
+        scope_key = (self.block_id_string, six.text_type(version_guid or ''))
+        if scope is not None and scope_key in scope:
+            self.xblock = scope[scope_key]
+            return
+
+        profiling.incr('structures_loaded')
+        key = (six.text_type(self.usage_key), six.text_type(version_guid or ''))
         if version_guid is not None:
-            self._get_version_xblock()
+            self.xblock = _single_flight.do(key, self._get_version_xblock)
         else:
-            store = modulestore()
-            with store.bulk_operations(self.usage_key.course_key):
-                try:
-                    self.xblock = store.get_item(self.usage_key, depth=None)
-                except Exception:
-                    raise GetItemError
+            self.xblock = _single_flight.do(key, self._get_published_xblock)
+
+        if scope is not None:
+            scope[scope_key] = self.xblock
+
+    def _get_published_xblock(self):
+        store = modulestore()
+        with store.bulk_operations(self.usage_key.course_key):
+            try:
+                xblock = store.get_item(self.usage_key, depth=None)
+            except ItemNotFoundError:
+                raise InvalidBlockError(self.block_id_string)
+            except Exception:
+                raise GetItemError
+
+        # concurrent loads of the block share it, see `_single_flight`
+        if getattr(xblock.runtime, 'module_data', None) is not None:
+            guard_runtime(xblock.runtime)
+        return xblock
 
     def _get_version_xblock(self):
 
@@ -68,38 +324,283 @@ class BlockStructure(object):
 
         store = modulestore()
 
+        item = None
         for s in store.modulestores:
             if isinstance(s, DraftVersioningModuleStore):
                 try:
-                    entry = s.get_structure(course_key, self.version_guid)
-                    course = CourseEnvelope(course_key.replace(version_guid=self.version_guid), entry)
-
-                    course_entry = course
-                    runtime = s._get_cache(course_entry.structure['_id'])
-
-                    if runtime is None:
+                    cache_key = self._runtime_cache_key()
+                    cached = runtime_cache.get(cache_key)
+                    if cached is None:
+                        entry = s.get_structure(course_key, self.version_guid)
+                        if entry is None:
+                            raise ItemNotFoundError(self.version_guid)
+                        course_entry = CourseEnvelope(course_key.replace(version_guid=self.version_guid), entry)
                         runtime = s.create_runtime(course_entry, lazy=True)
+                        guard_runtime(runtime)
+                        profiling.incr('runtimes_created')
+                    else:
+                        runtime, course_entry = cached
+                        # blocks loaded by earlier requests now count in its size
+                        update_runtime_size(cache_key, cached)
 
                     item = runtime.load_item(block_key, course_entry)
-
-                    self.xblock = item
+                    if cached is None:
+                        runtime_cache.set(cache_key, (runtime, course_entry), estimate_runtime_bytes(runtime))
+                except ItemNotFoundError:
+                    raise InvalidBlockError(self.block_id_string)
                 except Exception:
                     raise GetItemError
 
-    def get_xblocks(self):
+        return item
+
+    def _runtime_cache_key(self):
+        return u'{}@{}'.format(get_course_id(self.usage_key.course_key), self.version_guid)
+
+    def _split_runtime(self):
+        """
+        The split-mongo runtime the xblock was loaded with, or None.
+        """
+        runtime = getattr(self.xblock, 'runtime', None)
+        if getattr(runtime, 'course_entry', None) is None or getattr(runtime, 'module_data', None) is None:
+            return None
+        return runtime
+
+    def _cache_definitions(self, runtime, block_keys, depth):
+        """
+        Load the blocks `block_keys`, and their descendants down to `depth`, into
+        `runtime` together with their definitions, with one $in query.
+        """
+        for s in modulestore().modulestores:
+            if isinstance(s, DraftVersioningModuleStore):
+                with guard_runtime(runtime).lock:
+                    s.cache_items(runtime, block_keys, self.usage_key.course_key, depth=depth, lazy=False)
+                profiling.incr('definition_prefetches')
+
+                # re-estimate the size of a cached runtime now that it holds the XML
+                if self.version_guid:
+                    cache_key = self._runtime_cache_key()
+                    cached = runtime_cache.get(cache_key)
+                    if cached is not None and cached[0] is runtime:
+                        update_runtime_size(cache_key, cached)
+                return True
+        return False
+
+    def prefetch_definitions(self):
+        """
+        Load the definitions (the problem XML) of the subtree into the xblock's
+        runtime with one $in query, instead of one query per problem as its XML is
+        read. Blocks are loaded lazily, so only callers that read the XML of many
+        problems do this, before traversing. Return whether anything was fetched.
+        """
+        runtime = self._split_runtime()
+        if runtime is None:
+            return False
+
+        block_key = BlockKey.from_usage_key(self.usage_key)
+        data = runtime.module_data.get(block_key)
+        if data is not None and getattr(data, 'definition_loaded', False):
+            return False
+        return self._cache_definitions(runtime, [block_key], None)
+
+    def get_xblocks(self, prefetch=False):
+        """
+        The xblock and its descendants, breadth first. With `prefetch`, for callers
+        that read the XML of the problems, their definitions are loaded first.
+        """
         if self.xblocks is None:
+            if prefetch and self.usage_key is not None:
+                self.prefetch_definitions()
+            self.xblocks = list(traverse(self.xblock)) if self.usage_key is not None else []
+
+            # descendants of a published block are the published blocks themselves
+            scope = getattr(_request_scope, 'xblocks', None)
+            if scope is not None and not self.version_guid:
+                for x in self.xblocks:
+                    scope.setdefault((x.scope_ids.usage_id._to_string(), ''), x)
+
+        return self.xblocks
+
+    def get_problem_xblocks(self, usage_ids, prefetch=False):
+        """
+        The xblocks of the blocks `usage_ids` of this subtree, e.g. one page of
+        `get_problem_index`. On split-mongo only these blocks are built, and with
+        `prefetch` only their definitions are loaded, with one query; otherwise
+        they are picked from `get_xblocks`.
+        """
+        runtime = self._split_runtime()
+        if runtime is None:
+            xblocks = dict((x.scope_ids.usage_id._to_string(), x) for x in self.get_xblocks(prefetch))
+            return [xblocks[usage_id] for usage_id in usage_ids]
+
+        block_keys = [BlockKey.from_usage_key(UsageKey.from_string('block-v1:' + usage_id)) for usage_id in usage_ids]
+        if prefetch:
+            missing = [k for k in block_keys if not getattr(runtime.module_data.get(k), 'definition_loaded', False)]
+            if missing:
+                self._cache_definitions(runtime, missing, 0)
+        profiling.incr('xblocks_loaded', len(block_keys))
+        return [runtime.load_item(block_key, runtime.course_entry) for block_key in block_keys]
+
+    def get_problem_index(self):
+        """
+        Return a list describing the problems in this subtree, in `get_xblocks` order:
+
+            {'id': usage id, 'def_id': definition id, 'version': definition version,
+             'problem_types': [...], 'multi': bool}
+
+        `multi` is `ProblemParser.has_multi_problem`. Reading `problem_types` parses
+        each problem's XML, so the index is read from the course snapshot when there
+        is one, and otherwise cached per structure version.
+        """
+        if self.xblock is None:
+            return []
+
+        xblock_id = self.xblock.scope_ids.usage_id._to_string()
+        version = get_structure_version(self.xblock)
+        if version is not None:
+            snap = snapshot.get_snapshot(get_course_id(self.usage_key.course_key), version)
+            if snap is not None:
+                index = snap.get_problem_index(xblock_id)
+                if index is not None:
+                    return index
+
+            index = index_cache.get(xblock_id, version)
+            if index is not None:
+                return index
+
+        index = build_problem_index(self.get_xblocks(prefetch=True))
+
+        if version is not None:
+            index_cache.set(xblock_id, version, index)
+        return index
+
+
+class ProblemDefinition(object):
+    """
+    A problem at one definition version, with the attributes ProblemParser reads.
+    """
+
+    def __init__(self, usage_key, definition_id, data):
+        self.location = usage_key
+        self.scope_ids = ScopeIds(None, usage_key.block_type, definition_id, usage_key)
+        self.definition_locator = DefinitionLocator(usage_key.block_type, definition_id)
+        self.data = data
+
+    @property
+    def problem_types(self):
+        # same as CapaDescriptor.problem_types
+        capa = registry.load()
+        tree = etree.XML(self.data)
+        return {node.tag for node in tree.iter() if node.tag in capa.response_tags}
+
+
+def original_definition(definition):
+    """
+    Id of the first version of a split definition, shared by all its versions.
+    """
+    return (definition.get('edit_info') or {}).get('original_version') or definition.get('_id')
+
+
+def get_problem_definition(block_id_string, definition_version, published_version):
+    """
+    Load the problem `block_id_string` at `definition_version`, the `version` of
+    its parsed content, or return None when there is no such problem definition.
+
+    `published_version` is the definition of the published problem. Definitions
+    don't record their block, so one that isn't a version of the published
+    definition, i.e. of another problem, is rejected too.
+    """
+    try:
+        usage_key = UsageKey.from_string('block-v1:' + block_id_string)
+        definition_id = ObjectId(definition_version)
+        published_id = ObjectId(published_version)
+    except (InvalidKeyError, InvalidId, TypeError):
+        return None
+    if usage_key.block_type != 'problem':
+        return None
+
+    for s in getattr(modulestore(), 'modulestores', []):
+        if isinstance(s, DraftVersioningModuleStore):
+            try:
+                definition = s.get_definition(usage_key.course_key, definition_id)
+                published = s.get_definition(usage_key.course_key, published_id)
+            except Exception as ex:
+                log.warning("definition %s of %s: %s", definition_version, block_id_string, ex)
+                return None
+            if definition is None or definition.get('block_type') != 'problem':
+                return None
+            if published is None or original_definition(published) != original_definition(definition):
+                return None
+            profiling.incr('definitions_loaded')
+            return ProblemDefinition(usage_key, definition_id, definition.get('fields', {}).get('data', ''))
+    return None
+
+
+class InvalidationEvent(models.Model):
+    """
+    Change log of the `db` invalidation backend: one row per course publish.
+    """
+    course_id = models.CharField(max_length=255)
+    version = models.CharField(max_length=24, blank=True)
+    origin = models.CharField(max_length=100)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta(object):
+        db_table = 'problem_data_invalidation'
+
+
+class ProblemArchive(models.Model):
+    """
+    Parsed content of a problem at a definition version. A definition never
+    changes, so a row is written once and read by exams pinned to that version.
+    """
+    usage_id = models.CharField(max_length=200)
+    definition_version = models.CharField(max_length=24)
+    content = models.BinaryField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta(object):
+        db_table = 'problem_data_archive'
+        unique_together = (('usage_id', 'definition_version'),)
+
+    @classmethod
+    def get_contents(cls, keys):
+        """
+        Map each archived (usage id, definition version) among `keys` to its content.
+        """
+        keys = set(keys)
+        if not keys:
+            return {}
+
+        rows = cls.objects.filter(
+            usage_id__in=set(usage_id for usage_id, version in keys),
+            definition_version__in=set(version for usage_id, version in keys),
+        ).values_list('usage_id', 'definition_version', 'content')
+        return dict(
+            ((usage_id, version), decode(bytes(content)))
+            for usage_id, version, content in rows if (usage_id, version) in keys
+        )
+
+    @classmethod
+    def archive(cls, usage_id, version, content):
+        """
+        Store the content of a version unless it is already archived.
+        """
+        try:
+            with transaction.atomic():
+                cls.objects.create(usage_id=usage_id, definition_version=version, content=encode(content))
+            return True
+        except IntegrityError:
+            return False
 
-            self.xblocks = []
-            helperList = deque()
 
-            if self.usage_key is not None:
-                helperList.append(self.xblock)
+@receiver(SignalHandler.course_published)
+def broadcast_course_published(sender, course_key, **kwargs):  # pylint: disable=unused-argument
+    invalidation.publish(get_course_id(course_key), get_published_version(course_key))
 
-            while len(helperList) > 0:
-                tempElement = helperList.popleft()
-                if tempElement is not None:
-                    self.xblocks.append(tempElement)
-                    if hasattr(tempElement, "get_children"):
-                        helperList.extend(tempElement.get_children())
 
-        return self.xblocks if self.xblocks is not None else []
+@invalidation.subscribe
+def clear_invalid_blocks(course_id, version):  # pylint: disable=unused-argument
+    """
+    Blocks added by the publish may have been cached as invalid.
+    """
+    invalid_blocks.clear(course_id)
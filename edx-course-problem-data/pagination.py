@@ -1,8 +1,108 @@
 from __future__ import unicode_literals
 
-from rest_framework.pagination import PageNumberPagination
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+
+from django.utils.six.moves.urllib import parse as urlparse
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from .exceptions import InvalidCursorError
 
 
 class BlockNumberPagination(PageNumberPagination):
     page_size = 10
     page_size_query_param = 'page_size'
+
+
+class UserCursorPagination(CursorPagination):
+    """
+    Bounded pages ordered by primary key, without the COUNT(*) of page-number pagination.
+    """
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = 'id'
+
+
+class BlockCursorPagination(object):
+    """
+    Keyset pagination over a stable ordering of blocks.
+
+    The cursor holds the position to resume from together with the structure
+    version it was issued for, so the next page is served without evaluating
+    the items before it. Rows are given as (position, item) pairs, e.g. the
+    index in `BlockStructure.get_problem_index`.
+    """
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+
+    def __init__(self):
+        self.request = None
+        self.version = None
+        self.next_position = None
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def encode_cursor(self, position):
+        querystring = urlparse.urlencode({'p': position, 'v': self.version or ''}, doseq=True)
+        return b64encode(querystring.encode('ascii')).decode('ascii')
+
+    def decode_cursor(self, request, version):
+        """
+        Return the position encoded in the request's cursor, 0 for the first page.
+        """
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return 0
+
+        try:
+            querystring = b64decode(encoded.encode('ascii')).decode('ascii')
+            tokens = urlparse.parse_qs(querystring, keep_blank_values=True)
+            position = int(tokens['p'][0])
+            cursor_version = tokens.get('v', [''])[0]
+        except (TypeError, ValueError, KeyError, UnicodeError):
+            raise InvalidCursorError
+
+        if position < 0 or cursor_version != (version or ''):
+            raise InvalidCursorError
+        return position
+
+    def paginate_rows(self, rows, request, version):
+        """
+        Take one page from `rows`, peeking one row further to find the next cursor.
+        """
+        self.request = request
+        self.version = version
+        self.next_position = None
+
+        page_size = self.get_page_size(request)
+        page = []
+        for position, item in rows:
+            if len(page) == page_size:
+                self.next_position = position
+                break
+            page.append(item)
+        return page
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.next_position))
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data)
+        ]))
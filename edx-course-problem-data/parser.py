@@ -1,15 +1,243 @@
 # -*- coding: utf-8 -*-
 
+import io
 import re
+import threading
 from lxml import etree
 
-import capa.responsetypes as responsetypes
-import capa.inputtypes as inputtypes
+from django.conf import settings
 from django.utils.translation import ugettext as _
 from xmodule.stringify import stringify_children
 from collections import OrderedDict
 import traceback
 
+from . import profiling, snapshot
+from .cache import TwoTierCache
+
+# parsed problem content, keyed by definition version
+content_cache = TwoTierCache('content')
+_MISSING = object()
+
+
+def xpath(node, path, **variables):
+    """
+    Evaluate an XPath, a compiled `etree.XPath` or a string, on `node`,
+    counting it for request profiling.
+    """
+    profiling.incr('xpath_evaluations')
+    if isinstance(path, etree.XPath):
+        return path(node, **variables)
+    return node.xpath(path, **variables)
+
+
+# XPath expressions, compiled once
+CHOICES_BY_ID = etree.XPath('//*[@id=$id]//choice')
+CHOICEGROUPS = etree.XPath('choicegroup')
+SOLUTIONS = etree.XPath('//solution')
+PARAGRAPHS = etree.XPath('//p')
+TOP_PARAGRAPHS = etree.XPath('./p')
+ADDITIONAL_ANSWERS = etree.XPath('//stringresponse/additional_answer')
+OPTIONINPUTS = etree.XPath('//optioninput')
+PRECEDING_P = etree.XPath('preceding-sibling::*[1][self::p]')
+PRECEDING_LABEL = etree.XPath('preceding-sibling::*[1][self::label]')
+
+
+class CapaRegistry(object):
+    """
+    Tags of capa's registered response and input types, and the XPaths built
+    from them. Resolved on first parse, so importing this module doesn't import capa.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = False
+        self.response_tags = ()
+        self.input_tags = ()
+        self.questions = None
+        self._inputfields = {}
+
+    def load(self):
+        if self._loaded:
+            return self
+        with self._lock:
+            if not self._loaded:
+                import capa.responsetypes as responsetypes
+                import capa.inputtypes as inputtypes
+
+                self.response_tags = tuple(responsetypes.registry.registered_tags())
+                self.input_tags = tuple(inputtypes.registry.registered_tags())
+                self.questions = etree.XPath('//' + "|//".join(self.response_tags))
+                self._loaded = True
+        return self
+
+    def inputfields(self, response_tag):
+        """
+        XPath of the input fields of the `response_tag` response with id `$id`.
+        """
+        path = self._inputfields.get(response_tag)
+        if path is None:
+            path = etree.XPath("|".join(['//' + response_tag + '[@id=$id]//' + x for x in self.input_tags]))
+            self._inputfields[response_tag] = path
+        return path
+
+
+registry = CapaRegistry()
+
+
+# tags whose subtrees are read while parsing, besides the response and input types
+STREAM_KEEP_TAGS = frozenset(['p', 'label', 'solution'])
+
+
+def is_oversized(text):
+    """
+    Whether problem XML is long enough to be parsed with `iterparse_problem`.
+    """
+    min_size = getattr(settings, 'PROBLEM_DATA_STREAM_PARSE_MIN_SIZE', 256 * 1024)
+    return min_size is not None and len(text) >= min_size
+
+
+def _clear(elem, text=None):
+    """
+    Drop the children, text and attributes of `elem`, keeping its id and tail.
+    """
+    element_id, tail = elem.get('id'), elem.tail
+    elem.clear()
+    if element_id is not None:
+        elem.set('id', element_id)
+    elem.text, elem.tail = text, tail
+
+
+def iterparse_problem(text):
+    """
+    Parse oversized problem XML with `etree.iterparse`, keeping only what
+    `ProblemParser.parse_content` reads:
+
+    * subtrees without response types, inputs, paragraphs, labels or solutions
+      (inline HTML, embedded images) are cleared as soon as they end
+    * solutions are reduced to their text, unless they contain responses or choices
+
+    Cleared elements stay in place with their ids, so the XPaths and the
+    numbering of paragraphs, solutions and responses are the same as on the
+    full tree.
+
+    Return the root and the response types found, as `CapaDescriptor.problem_types`.
+    """
+    capa = registry.load()
+    keep = STREAM_KEEP_TAGS.union(capa.response_tags, capa.input_tags)
+    blockers = frozenset(['choice', 'solution']).union(capa.response_tags, capa.input_tags)
+
+    root = None
+    problem_types = set()
+    # per open element: [in a kept subtree, has a kept descendant, has a blocker descendant]
+    stack = []
+    for event, elem in etree.iterparse(io.BytesIO(text.encode('utf-8')), events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            if elem.tag in capa.response_tags:
+                problem_types.add(elem.tag)
+            stack.append([elem.tag in keep or (bool(stack) and stack[-1][0]), False, False])
+            continue
+
+        kept, needed, blocked = stack.pop()
+        if elem.tag == 'solution' and not blocked:
+            _clear(elem, etree.tostring(elem, encoding='unicode', method='text', with_tail=False))
+        elif not (kept or needed) and stack:
+            _clear(elem)
+
+        if stack:
+            parent = stack[-1]
+            parent[1] = parent[1] or kept or needed
+            parent[2] = parent[2] or blocked or elem.tag in blockers
+
+    return root, problem_types
+
+
+def count_root_children(text, tag, limit=None):
+    """
+    `len(etree.XML(text).findall(tag))`, streamed and stopping at `limit`.
+    """
+    count = 0
+    depth = 0
+    for event, elem in etree.iterparse(io.BytesIO(text.encode('utf-8')), events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            continue
+
+        depth -= 1
+        if depth == 1:
+            if elem.tag == tag:
+                count += 1
+                if limit is not None and count >= limit:
+                    break
+            elem.clear()
+    return count
+
+
+# every key of a parsed problem; `id` is always returned
+CONTENT_FIELDS = (
+    'id', 'type', 'version', 'title', 'group_label', 'descriptions', 'options', 'answers', 'solution',
+)
+
+
+def parse_fields(value):
+    """
+    Parse a `fields` parameter, a comma separated string or a list, into a
+    frozenset of content fields. None means all fields.
+    """
+    if not value:
+        return None
+    if not isinstance(value, (list, tuple)):
+        value = value.split(',')
+    fields = frozenset(f.strip() for f in value) & frozenset(CONTENT_FIELDS)
+    return fields | frozenset(['id'])
+
+
+def wants(fields, *names):
+    return fields is None or any(name in fields for name in names)
+
+
+def select_fields(data, fields):
+    """
+    Keep only `fields` of parsed content, a dict, a list of dicts or None.
+    """
+    if fields is None or data is None:
+        return data
+    if isinstance(data, list):
+        return [select_fields(d, fields) for d in data]
+    return dict((k, v) for k, v in data.items() if k in fields)
+
+
+def content_cache_key(xblock_id, fields):
+    if fields is None:
+        return xblock_id
+    return xblock_id + '|' + ','.join(sorted(fields))
+
+
+def get_cached_content(xblock_id, version, fields=None, snap=None):
+    """
+    Content of a problem at definition `version` from the course snapshot `snap`
+    or the content cache, or `_MISSING`.
+    """
+    # 预先生成的课程快照，各 worker 共享
+    if snap is not None:
+        data = snap.get_content(xblock_id, version)
+        if data is not None:
+            return select_fields(data, fields)
+
+    # 完整内容的缓存可以满足任意 fields
+    data = content_cache.get(xblock_id, version, _MISSING)
+    if data is not _MISSING:
+        return select_fields(data, fields)
+    if fields is None:
+        return _MISSING
+    return content_cache.get(content_cache_key(xblock_id, fields), version, _MISSING)
+
+
+def is_content_cached(xblock_id, version, fields=None, snap=None):
+    return get_cached_content(xblock_id, version, fields, snap) is not _MISSING
+
+
 # extra things displayed after "show answers" is pressed
 solution_tags = ['solution']
 
@@ -31,10 +259,12 @@ response_properties = ["codeparam",
 
 class MultipleChoiceResponse(object):
 
-    def __init__(self, xml, problem_data):
+    def __init__(self, xml, problem_data, fields=None):
         self.xml = xml
         self.problem_data = problem_data
-        self.setup_response()
+        self.fields = fields
+        if wants(fields, 'options', 'answers'):
+            self.setup_response()
 
     def setup_response(self):
         """
@@ -51,7 +281,7 @@ class MultipleChoiceResponse(object):
 
         # define correct choices (after calling secondary setup)
         xml = self.xml
-        cxml = xml.xpath('//*[@id=$id]//choice', id=xml.get('id'))
+        cxml = xpath(xml, CHOICES_BY_ID, id=xml.get('id'))
 
         # contextualize correct attribute and then select ones for which
         # correct = "true"
@@ -71,7 +301,7 @@ class MultipleChoiceResponse(object):
         Masks the choice names if applicable.
         """
         i = 0
-        for response in self.xml.xpath("choicegroup"):
+        for response in xpath(self.xml, CHOICEGROUPS):
             # Is Masking enabled? -- check for shuffle or answer-pool features
             # Masking (self._has_mask) is off, to be re-enabled with a future PR.
             rtype = response.get('type')
@@ -98,12 +328,22 @@ class MultipleChoiceResponse(object):
                 choice.set("name", name)
 
     def get_answers(self):
-        self.problem_data.update({
-            'options': self.choices,
-            'answers': self.correct_choices,
-        })
+        if wants(self.fields, 'options', 'answers'):
+            self.problem_data.update({
+                'options': self.choices,
+                'answers': self.correct_choices,
+            })
+
+        if wants(self.fields, 'solution'):
+            self.get_solution()
+
+        if wants(self.fields, 'title'):
+            self.get_title()
 
-        for solution in self.xml.xpath('//solution', id=self.xml.get('id')):
+        return self.problem_data
+
+    def get_solution(self):
+        for solution in xpath(self.xml, SOLUTIONS):
             answer = etree.tostring(solution, encoding='unicode', method='text')
             if answer:
                 answer = answer.replace(' ', '').replace("\n", "").strip()
@@ -111,26 +351,27 @@ class MultipleChoiceResponse(object):
             else:
                 self.problem_data.update({'solution': ''})
 
+    def get_title(self):
         title = self.problem_data.get('title', '')
         if title == '':
-            for p in self.xml.xpath('//p'):
+            for p in xpath(self.xml, PARAGRAPHS):
                 if p.attrib.get('id') == self.xml.get('id'):
                     p_text = p.text
                     self.problem_data['title'] = p_text
 
-        return self.problem_data
-
 
 class ChoiceResponse(object):
 
-    def __init__(self, xml, problem_data):
+    def __init__(self, xml, problem_data, fields=None):
         self.xml = xml
         self.problem_data = problem_data
-        self.setup_response()
+        self.fields = fields
+        if wants(fields, 'options', 'answers'):
+            self.setup_response()
 
     def get_choices(self):
         """Returns this response's XML choice elements."""
-        return self.xml.xpath('//*[@id=$id]//choice', id=self.xml.get('id'))
+        return xpath(self.xml, CHOICES_BY_ID, id=self.xml.get('id'))
 
     def assign_choice_names(self):
         """
@@ -161,12 +402,22 @@ class ChoiceResponse(object):
             self.choices.append(choice.text)
 
     def get_answers(self):
-        self.problem_data.update({
-            'options': self.choices,
-            'answers': self.correct_choices,
-        })
+        if wants(self.fields, 'options', 'answers'):
+            self.problem_data.update({
+                'options': self.choices,
+                'answers': self.correct_choices,
+            })
+
+        if wants(self.fields, 'solution'):
+            self.get_solution()
+
+        if wants(self.fields, 'title'):
+            self.get_title()
+
+        return self.problem_data
 
-        for solution in self.xml.xpath('//solution', id=self.xml.get('id')):
+    def get_solution(self):
+        for solution in xpath(self.xml, SOLUTIONS):
             answer = etree.tostring(solution, encoding='unicode', method='text')
             if answer:
                 answer = answer.replace(' ', '').replace("\n", "").strip()
@@ -174,22 +425,23 @@ class ChoiceResponse(object):
             else:
                 self.problem_data.update({'solution': ''})
 
+    def get_title(self):
         title = self.problem_data.get('title', '')
         if title == '':
-            for p in self.xml.xpath('//p'):
+            for p in xpath(self.xml, PARAGRAPHS):
                 if p.attrib.get('id') == self.xml.get('id'):
                     p_text = p.text
                     self.problem_data['title'] = p_text
 
-        return self.problem_data
-
 
 class StringResponse(object):
 
-    def __init__(self, xml, problem_data):
+    def __init__(self, xml, problem_data, fields=None):
         self.xml = xml
         self.problem_data = problem_data
-        self.setup_response()
+        self.fields = fields
+        if wants(fields, 'options', 'answers'):
+            self.setup_response()
 
     def setup_response_backward(self):
         self.correct_answer = [
@@ -221,11 +473,21 @@ class StringResponse(object):
     def get_answers(self):
         # Translators: Separator used in StringResponse to display multiple answers.
         # Example: "Answer: Answer_1 or Answer_2 or Answer_3".
-        self.problem_data.update({
-            'answers': self.correct_answer,
-        })
+        if wants(self.fields, 'answers'):
+            self.problem_data.update({
+                'answers': self.correct_answer,
+            })
+
+        if wants(self.fields, 'solution'):
+            self.get_solution()
+
+        if wants(self.fields, 'title'):
+            self.get_title()
+
+        return self.problem_data
 
-        for solution in self.xml.xpath('//solution', id=self.xml.get('id')):
+    def get_solution(self):
+        for solution in xpath(self.xml, SOLUTIONS):
             answer = etree.tostring(solution, encoding='unicode', method='text')
             if answer:
                 answer = answer.replace(' ', '').replace("\n", "").strip()
@@ -233,33 +495,62 @@ class StringResponse(object):
             else:
                 self.problem_data.update({'solution': ''})
 
+    def get_title(self):
         title = self.problem_data.get('title', '')
         if title == '':
-            for p in self.xml.xpath('//p'):
+            for p in xpath(self.xml, PARAGRAPHS):
                 if p.attrib.get('id') == self.xml.get('id'):
                     p_text = p.text
                     self.problem_data['title'] = p_text
 
-        return self.problem_data
-
 
 class ProblemParser(object):
 
-    def __init__(self, xblock):
+    def __init__(self, xblock, fields=None):
+        """
+        Arguments:
+            xblock: the problem xblock
+            fields (frozenset): content fields to compute, see `parse_fields`; None for all
+        """
         self.xblock = xblock
+        self.fields = fields
         self.xblock_id = xblock.scope_ids.usage_id._to_string()
         self.problem_id = xblock.scope_ids.usage_id.block_id
+        self.version = str(xblock.definition_locator.definition_id)
+
+        self.markdown = None
+        self.problem_type = None
+        self.problem_text = None
+        self.tree = None
+
+    def load(self):
+        """
+        Parse the problem XML. Deferred until needed so that cached content
+        never reads the definition.
+        """
+        if self.tree is not None:
+            return
+
+        xblock = self.xblock
         self.markdown = xblock.data
-        self.problem_type = ProblemParser.parse_type(xblock.problem_types)
 
         # Convert startouttext and endouttext to proper <text></text>
         problem_text = xblock.data
-        problem_text = re.sub(r"startouttext\s*/", "text", problem_text)
-        problem_text = re.sub(r"endouttext\s*/", "/text", problem_text)
+        if 'outtext' in problem_text:
+            problem_text = re.sub(r"startouttext\s*/", "text", problem_text)
+            problem_text = re.sub(r"endouttext\s*/", "/text", problem_text)
         self.problem_text = problem_text
 
         # parse problem XML file into an element tree
-        self.tree = etree.XML(problem_text)
+        if is_oversized(problem_text):
+            # 超长的题目流式解析，题型也在解析时得到，不再由 xblock.problem_types 完整解析一遍
+            self.tree, problem_types = iterparse_problem(problem_text)
+            profiling.incr('xml_streamed')
+        else:
+            problem_types = xblock.problem_types
+            self.tree = etree.XML(problem_text)
+        profiling.incr('xml_parsed')
+        self.problem_type = ProblemParser.parse_type(problem_types)
 
         self.make_xml_compatible(self.tree)
 
@@ -284,7 +575,7 @@ class ProblemParser(object):
         so all downstream logic works unchanged with the new <option> tag format.
         """
 
-        additionals = tree.xpath('//stringresponse/additional_answer')
+        additionals = xpath(tree, ADDITIONAL_ANSWERS)
         for additional in additionals:
             answer = additional.get('answer')
             text = additional.text
@@ -292,7 +583,7 @@ class ProblemParser(object):
                 additional.set('answer', text)
                 additional.text = ''
 
-        for optioninput in tree.xpath('//optioninput'):
+        for optioninput in xpath(tree, OPTIONINPUTS):
             correct_option = None
             child_options = []
             for option_element in optioninput.findall('./option'):
@@ -316,6 +607,15 @@ class ProblemParser(object):
         可选答案
         提示
         """
+        data = get_cached_content(self.xblock_id, self.version, self.fields, snapshot.get_xblock_snapshot(self.xblock))
+        if data is _MISSING:
+            data = self.parse_content()
+            content_cache.set(content_cache_key(self.xblock_id, self.fields), self.version, data)
+        return data
+
+    def parse_content(self):
+        self.load()
+
         p_id = 1
         response_id = 1
         solution_id = 1
@@ -323,19 +623,20 @@ class ProblemParser(object):
         tree = self.tree
 
         # 遍历 p 标签
-        for ptag in tree.xpath('./p'):
+        for ptag in xpath(tree, TOP_PARAGRAPHS):
             ptag_id = self.xblock_id + "_" + str(p_id)
             ptag.set('id', ptag_id)
             p_id += 1
 
         # 遍历 solution 标签
-        for sol in tree.xpath('//solution'):
+        for sol in xpath(tree, SOLUTIONS):
             sol_id = self.xblock_id + "_" + str(solution_id)
             sol.set('id', sol_id)
             solution_id += 1
 
         # 可能有多个小题
-        questions = tree.xpath('//' + "|//".join(responsetypes.registry.registered_tags()))
+        capa = registry.load()
+        questions = xpath(tree, capa.questions)
         for response in questions:
 
             responsetype_id = self.xblock_id + "_" + str(response_id)
@@ -345,11 +646,7 @@ class ProblemParser(object):
 
             # 题干
             answer_id = 1
-            input_tags = inputtypes.registry.registered_tags()
-            inputfields = tree.xpath(
-                "|".join(['//' + response.tag + '[@id=$id]//' + x for x in input_tags]),
-                id=responsetype_id
-            )
+            inputfields = xpath(tree, capa.inputfields(response.tag), id=responsetype_id)
 
             # 选项
             # assign one answer_id for each input type
@@ -361,7 +658,8 @@ class ProblemParser(object):
 
             # 找出标题
             problem_data = {}
-            self.response_a11y_data(response, inputfields, responsetype_id, problem_data)
+            if wants(self.fields, 'title', 'group_label', 'descriptions'):
+                self.response_a11y_data(response, inputfields, responsetype_id, problem_data)
 
             # 实际解析
             data = self.get_content_by_type(response, problem_data, responsetype_id, questions)
@@ -379,37 +677,37 @@ class ProblemParser(object):
     def get_content_by_type(self, response, problem_data, responsetype_id, questions):
         # 按照题型获取不同的答案
         if self.problem_type == "multiplechoiceresponse":
-            res = MultipleChoiceResponse(response, problem_data)
+            res = MultipleChoiceResponse(response, problem_data, self.fields)
             data = res.get_answers()
             data.update({
                 'id': responsetype_id if len(questions) > 1 else self.xblock_id,
                 'type': self.problem_type,
-                'version': str(self.xblock.definition_locator.definition_id)
+                'version': self.version
             })
 
         elif self.problem_type == "choiceresponse":
-            res = ChoiceResponse(response, problem_data)
+            res = ChoiceResponse(response, problem_data, self.fields)
             data = res.get_answers()
             data.update({
                 'id': responsetype_id if len(questions) > 1 else self.xblock_id,
                 'type': self.problem_type,
-                'version': str(self.xblock.definition_locator.definition_id)
+                'version': self.version
             })
 
         elif self.problem_type == "stringresponse":
-            res = StringResponse(response, problem_data)
+            res = StringResponse(response, problem_data, self.fields)
             data = res.get_answers()
             data.update({
                 'id': responsetype_id if len(questions) > 1 else self.xblock_id,
                 'type': self.problem_type,
-                'version': str(self.xblock.definition_locator.definition_id)
+                'version': self.version
             })
 
         # 过滤题型
         else:
             data = None
 
-        return data
+        return select_fields(data, self.fields)
 
     def response_a11y_data(self, response, inputfields, responsetype_id, problem_data):
         """
@@ -471,7 +769,7 @@ class ProblemParser(object):
                 # we will pick the first sibling of responsetype if its a p tag and match the text with
                 # the label attribute text. if they are equal then we will use this text as question.
                 # Get first <p> tag before responsetype, this <p> may contains the question text.
-                p_tag = response.xpath('preceding-sibling::*[1][self::p]')
+                p_tag = xpath(response, PRECEDING_P)
 
                 if p_tag and p_tag[0].text == inputfields[0].attrib['label']:
                     label = stringify_children(p_tag[0])
@@ -480,7 +778,7 @@ class ProblemParser(object):
                 # In this case the problems don't have tag or label attribute inside the responsetype
                 # so we will get the first preceding label tag w.r.t to this responsetype.
                 # This will take care of those multi-question problems that are not using --- in their markdown.
-                label_tag = response.xpath('preceding-sibling::*[1][self::label]')
+                label_tag = xpath(response, PRECEDING_LABEL)
                 if label_tag:
                     label = stringify_children(label_tag[0])
                     element_to_be_deleted = label_tag[0]
@@ -514,12 +812,16 @@ class ProblemParser(object):
 
     @staticmethod
     def has_multi_problem(problem):
-        tree = etree.XML(problem.data)
         ptype = ProblemParser.parse_type(problem.problem_types)
 
         if isinstance(ptype, set):
             return True
+        elif is_oversized(problem.data):
+            profiling.incr('xml_streamed')
+            return count_root_children(problem.data, ptype, limit=2) > 1
         else:
+            tree = etree.XML(problem.data)
+            profiling.incr('xml_parsed')
             occurs = tree.findall(ptype)
             if len(occurs) > 1:
                 return True
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+按请求的性能分析（仅 staff）
+
+开启 PROBLEM_DATA_PROFILING 后，staff 用户在请求上带 `X-Problem-Data-Profile: 1`
+请求头或 `?profile=1` 参数，该请求就会在 cProfile 下运行，并统计加载的 XBlock
+数量、解析的 XML 文档数和 ProblemParser 执行的 XPath 次数。
+
+Settings:
+    PROBLEM_DATA_PROFILING     是否允许按请求开启 profile，默认 False
+    PROBLEM_DATA_PROFILE_DIR   .prof 文件的输出目录，None 表示把统计结果写到日志
+"""
+from __future__ import unicode_literals
+
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+
+log = logging.getLogger("exam.api")
+
+PROFILE_HEADER = 'HTTP_X_PROBLEM_DATA_PROFILE'
+PROFILE_QUERY_PARAM = 'profile'
+
+_local = threading.local()
+
+
+def incr(name, count=1):
+    """
+    Add to a counter of the request being profiled; a no-op otherwise.
+    """
+    counters = getattr(_local, 'counters', None)
+    if counters is not None:
+        counters[name] += count
+
+
+def propagate(fn):
+    """
+    Wrap `fn` to run in a worker thread, adding its counters to the request being
+    profiled by the calling thread.
+    """
+    counters = getattr(_local, 'counters', None)
+    if counters is None:
+        return fn
+
+    lock = threading.Lock()
+
+    def wrapper(*args, **kwargs):
+        _local.counters = Counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with lock:
+                counters.update(_local.counters)
+            _local.counters = None
+
+    return wrapper
+
+
+def should_profile(request):
+    if not getattr(settings, 'PROBLEM_DATA_PROFILING', False):
+        return False
+    if not (request.META.get(PROFILE_HEADER) or request.query_params.get(PROFILE_QUERY_PARAM)):
+        return False
+    return bool(getattr(request.user, 'is_staff', False))
+
+
+class RequestProfile(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.profiler = cProfile.Profile()
+        self.counters = Counter()
+        self.started = None
+
+    def start(self):
+        _local.counters = self.counters
+        self.started = time.time()
+        self.profiler.enable()
+
+    def stop(self):
+        self.profiler.disable()
+        _local.counters = None
+        self.elapsed = time.time() - self.started
+
+    def save(self):
+        directory = getattr(settings, 'PROBLEM_DATA_PROFILE_DIR', None)
+        summary = 'profile %s: %.1f ms, %s' % (self.name, self.elapsed * 1000, json.dumps(self.counters, sort_keys=True))
+
+        if directory is not None:
+            filename = '{}-{}-{}.prof'.format(time.strftime('%Y%m%d%H%M%S'), os.getpid(), self.name)
+            path = os.path.join(directory, filename)
+            self.profiler.dump_stats(path)
+            log.info("%s, saved to %s", summary, path)
+        else:
+            stream = io.StringIO() if str is not bytes else io.BytesIO()
+            pstats.Stats(self.profiler, stream=stream).sort_stats('cumulative').print_stats(50)
+            log.info("%s\n%s", summary, stream.getvalue())
+
+
+class ProfileMixin(object):
+    """
+    Profile the request when a staff user asks for it, see `should_profile`.
+    """
+
+    def initial(self, request, *args, **kwargs):
+        super(ProfileMixin, self).initial(request, *args, **kwargs)
+        self._profile = None
+        if should_profile(request):
+            self._profile = RequestProfile(self.__class__.__name__)
+            self._profile.start()
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super(ProfileMixin, self).finalize_response(request, response, *args, **kwargs)
+
+        profile = getattr(self, '_profile', None)
+        if profile is not None:
+            self._profile = None
+            profile.stop()
+            try:
+                profile.save()
+            except Exception as ex:
+                log.error(ex)
+            response['X-Problem-Data-Profile'] = json.dumps(profile.counters, sort_keys=True)
+
+        return response
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+题目接口的 JSON renderer
+
+* 有 ujson / rapidjson 时用更快的编码器，否则退回 DRF 默认实现
+* 响应体超过阈值、且客户端支持时，使用 brotli 或 gzip 压缩
+
+Settings:
+    PROBLEM_DATA_COMPRESS_MIN_BYTES  超过该字节数才压缩，None 表示不压缩
+"""
+from __future__ import unicode_literals
+
+import gzip
+import io
+
+import six
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from rest_framework.renderers import JSONRenderer
+
+try:
+    import ujson as fast_json
+    FAST_JSON_OPTIONS = {'escape_forward_slashes': False}
+except ImportError:
+    try:
+        import rapidjson as fast_json
+        FAST_JSON_OPTIONS = {}
+    except ImportError:
+        fast_json = None
+        FAST_JSON_OPTIONS = {}
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def accepted_encodings(accept_encoding):
+    return set(e.split(';')[0].strip().lower() for e in accept_encoding.split(','))
+
+
+def compress(data, accept_encoding):
+    """
+    Return (encoding, body) for the best encoding accepted by the client, or (None, data).
+    """
+    encodings = accepted_encodings(accept_encoding)
+    if brotli is not None and 'br' in encodings:
+        return 'br', brotli.compress(data)
+    if 'gzip' in encodings:
+        buf = io.BytesIO()
+        with gzip.GzipFile(mode='wb', compresslevel=6, fileobj=buf, mtime=0) as f:
+            f.write(data)
+        return 'gzip', buf.getvalue()
+    return None, data
+
+
+class ProblemJSONRenderer(JSONRenderer):
+    """
+    JSON renderer for the large problem payloads of this app.
+    """
+
+    def encode(self, data, accepted_media_type, renderer_context):
+        if fast_json is not None and not self.get_indent(accepted_media_type, renderer_context):
+            try:
+                ret = fast_json.dumps(data, ensure_ascii=self.ensure_ascii, **FAST_JSON_OPTIONS)
+            except (TypeError, OverflowError):
+                pass
+            else:
+                if isinstance(ret, six.text_type):
+                    ret = ret.encode('utf-8')
+                return ret
+        return super(ProblemJSONRenderer, self).render(data, accepted_media_type, renderer_context)
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return bytes()
+
+        renderer_context = renderer_context or {}
+        body = self.encode(data, accepted_media_type, renderer_context)
+
+        min_bytes = getattr(settings, 'PROBLEM_DATA_COMPRESS_MIN_BYTES', 16 * 1024)
+        request = renderer_context.get('request')
+        response = renderer_context.get('response')
+        if min_bytes is None or request is None or response is None or len(body) < min_bytes:
+            return body
+        # only the response body itself, not e.g. the content BrowsableAPIRenderer embeds in its page
+        if getattr(response, 'accepted_renderer', None) is not self or renderer_context.get('indent'):
+            return body
+        if response.has_header('Content-Encoding'):
+            return body
+
+        encoding, body = compress(body, request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is not None:
+            response['Content-Encoding'] = encoding
+            patch_vary_headers(response, ('Accept-Encoding',))
+        return body
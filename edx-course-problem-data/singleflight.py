@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Single-flight 请求合并
+
+同一进程内同一时刻对同一课程 (course, version) 的多个加载请求，只真正执行一次，
+其余线程等待并共享结果。
+
+加载结果是 xblock，无法在进程之间共享，因此不做跨 worker 的合并。
+只有多线程的 worker（如 gunicorn 的 gthread、uWSGI 的 threads）才会合并；
+gunicorn 默认的 sync worker 每个进程同时只处理一个请求，合并不起作用。
+
+Settings:
+    PROBLEM_DATA_SINGLE_FLIGHT_TIMEOUT 等待领头请求的最长秒数
+"""
+from __future__ import unicode_literals
+
+import logging
+import threading
+
+from django.conf import settings
+
+log = logging.getLogger("mongo.api")
+
+
+class _Call(object):
+    """
+    An in-flight load shared by every thread asking for the same key.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'PROBLEM_DATA_SINGLE_FLIGHT_TIMEOUT', 30)
+
+    def do(self, key, fn):
+        """
+        Run `fn` once for all concurrent callers with the same `key`.
+
+        Arguments:
+            key (tuple): tuple of strings identifying the load, e.g. (usage_key, version)
+            fn (callable): the actual load, called without arguments
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            if call.event.wait(self.timeout):
+                if call.error is not None:
+                    raise call.error
+                return call.result
+            # 领头请求超时，自己加载
+            log.warning("single flight wait timeout: %s", key)
+            return fn()
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as ex:
+            call.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+课程题目快照：每个 (课程, structure 版本) 一个只读的 SQLite 文件
+
+由 `build_problem_snapshot` 命令生成，包含课程内每个 block 的题目索引
+（`BlockStructure.get_problem_index`）和每道题的完整解析结果（`ProblemParser.get_content`）。
+各 worker 以只读方式打开，并通过 mmap 读取，同一台机器上的 worker 共享操作系统的
+页缓存，热门课程的内容只占一份内存，也不再进入每个进程自己的 LRU。
+
+Settings:
+    PROBLEM_DATA_SNAPSHOT_DIR         快照目录，None 表示不使用快照
+    PROBLEM_DATA_SNAPSHOT_MMAP_BYTES  每个快照连接 mmap 的最大字节数
+"""
+from __future__ import unicode_literals
+
+import logging
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import six
+from django.conf import settings
+
+from .cache import decode, encode
+
+log = logging.getLogger("mongo.api")
+
+SCHEMA = [
+    "CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)",
+    "CREATE TABLE problem_index (block_id TEXT PRIMARY KEY, data BLOB)",
+    "CREATE TABLE content (problem_id TEXT PRIMARY KEY, def_id TEXT, data BLOB)",
+]
+
+# 每个进程最多同时打开的快照数
+MAX_OPEN_SNAPSHOTS = 32
+
+_snapshots = OrderedDict()
+_lock = threading.Lock()
+
+
+def get_snapshot_dir():
+    return getattr(settings, 'PROBLEM_DATA_SNAPSHOT_DIR', None)
+
+
+def get_snapshot_path(course_id, version, directory=None):
+    directory = directory or get_snapshot_dir()
+    return os.path.join(directory, re.sub(r'[^\w.-]', '_', course_id), '{}.sqlite3'.format(version))
+
+
+def is_snapshot_file(path):
+    """
+    Whether `path` exists and isn't empty, without creating it.
+    """
+    try:
+        return os.stat(path).st_size > 0
+    except OSError:
+        return False
+
+
+class Snapshot(object):
+    """
+    A read-only snapshot file. Each thread gets its own connection; the pages
+    are shared through the mmap.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            # connect() would create an empty file in place of a removed snapshot
+            if not is_snapshot_file(self.path):
+                raise sqlite3.OperationalError("snapshot removed: {}".format(self.path))
+            conn = sqlite3.connect(self.path)
+            conn.execute('PRAGMA query_only = ON')
+            conn.execute('PRAGMA mmap_size = {:d}'.format(
+                getattr(settings, 'PROBLEM_DATA_SNAPSHOT_MMAP_BYTES', 256 * 1024 * 1024)
+            ))
+            self._local.connection = conn
+        return conn
+
+    def fetchone(self, sql, params):
+        """
+        Run a query, returning None when the snapshot can't be read, e.g. after
+        `remove_old_snapshots` removed it; callers then use the modulestore.
+        """
+        try:
+            return self.connection.execute(sql, params).fetchone()
+        except sqlite3.Error as ex:
+            log.warning("snapshot %s: %s", self.path, ex)
+            forget_snapshot(self.path)
+            return None
+
+    def get_problem_index(self, block_id):
+        row = self.fetchone('SELECT data FROM problem_index WHERE block_id = ?', (block_id,))
+        return decode(bytes(row[0])) if row is not None else None
+
+    def get_content(self, problem_id, def_id):
+        """
+        Full content of a problem, or None unless the snapshot has it at definition `def_id`.
+        """
+        row = self.fetchone('SELECT def_id, data FROM content WHERE problem_id = ?', (problem_id,))
+        if row is None or row[0] != def_id:
+            return None
+        return decode(bytes(row[1]))
+
+
+def get_snapshot(course_id, version):
+    """
+    Return the snapshot of `course_id` at structure `version`, or None when it
+    hasn't been built or snapshots are disabled.
+    """
+    if get_snapshot_dir() is None or version is None:
+        return None
+
+    path = get_snapshot_path(course_id, version)
+    with _lock:
+        snapshot = _snapshots.pop(path, None)
+        if snapshot is None:
+            if not is_valid_snapshot(path, course_id, version):
+                return None
+            snapshot = Snapshot(path)
+        _snapshots[path] = snapshot
+        while len(_snapshots) > MAX_OPEN_SNAPSHOTS:
+            _snapshots.popitem(last=False)
+    return snapshot
+
+
+def forget_snapshot(path):
+    with _lock:
+        _snapshots.pop(path, None)
+
+
+def get_xblock_snapshot(xblock):
+    """
+    Snapshot of the course structure the xblock was loaded from.
+    """
+    if get_snapshot_dir() is None:
+        return None
+
+    from .models import get_course_id, get_structure_version
+    return get_snapshot(get_course_id(xblock.location.course_key), get_structure_version(xblock))
+
+
+def is_valid_snapshot(path, course_id, version):
+    """
+    Whether `path` is a complete snapshot of `course_id` at `version`.
+    """
+    if not is_snapshot_file(path):
+        return False
+    try:
+        conn = sqlite3.connect(path)
+        try:
+            meta = dict(conn.execute('SELECT key, value FROM meta').fetchall())
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return False
+    return meta.get('course_id') == six.text_type(course_id) and meta.get('version') == six.text_type(version)
+
+
+def build_snapshot(course_id, directory=None):
+    """
+    Write the snapshot of the published version of `course_id` and return its
+    path, or None for courses without a structure version (old mongo).
+    """
+    from .models import BlockStructure, build_problem_index, get_course_id, get_structure_version, traverse
+    from .parser import ProblemParser
+
+    course = BlockStructure(course_id)
+    course_id = get_course_id(course.usage_key.course_key)
+    version = get_structure_version(course.xblock)
+    if version is None:
+        return None
+
+    path = get_snapshot_path(course_id, version, directory)
+    if is_valid_snapshot(path, course_id, version):
+        return path
+
+    xblocks = course.get_xblocks(prefetch=True)
+    entries = dict((entry['id'], entry) for entry in build_problem_index(xblocks))
+
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    fd, tmp = tempfile.mkstemp(prefix='.snapshot', dir=os.path.dirname(path))
+    os.close(fd)
+
+    try:
+        conn = sqlite3.connect(tmp)
+        for statement in SCHEMA:
+            conn.execute(statement)
+
+        conn.executemany('INSERT INTO meta VALUES (?, ?)', [
+            ('course_id', course_id),
+            ('version', version),
+            ('built_at', six.text_type(int(time.time()))),
+        ])
+
+        for xblock in xblocks:
+            xblock_id = xblock.scope_ids.usage_id._to_string()
+            index = [entries[x.scope_ids.usage_id._to_string()] for x in traverse(xblock)
+                     if x.scope_ids.block_type == 'problem']
+            conn.execute('INSERT INTO problem_index VALUES (?, ?)', (xblock_id, sqlite3.Binary(encode(index))))
+
+            if xblock_id in entries and entries[xblock_id]['problem_types']:
+                try:
+                    parser = ProblemParser(xblock)
+                    data = parser.get_content()
+                except Exception as ex:
+                    log.error("snapshot of %s: %s", xblock_id, ex)
+                    continue
+                conn.execute('INSERT INTO content VALUES (?, ?, ?)',
+                             (xblock_id, parser.version, sqlite3.Binary(encode(data))))
+
+        conn.commit()
+        conn.close()
+
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+    return path
+
+
+def remove_old_snapshots(path, keep):
+    """
+    Remove all but the `keep` newest snapshots in the course directory of `path`.
+    Workers that still have one open keep reading it until they close it.
+    """
+    course_dir = os.path.dirname(path)
+    paths = [os.path.join(course_dir, name) for name in os.listdir(course_dir) if name.endswith('.sqlite3')]
+    paths.sort(key=os.path.getmtime, reverse=True)
+    for old in paths[keep:]:
+        os.remove(old)
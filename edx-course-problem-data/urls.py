@@ -7,6 +7,9 @@ from .views import (
     SectionProblemView,
     DetailView,
     UserViewSet,
+    CacheStatsView,
+    InventoryView,
+    BatchView,
 
 )
 from django.conf.urls import url
@@ -23,6 +26,9 @@ urlpatterns = [
     url(r'^problem/types$', TypeView.as_view()),
     url(r'^section/problems$', SectionProblemView.as_view()),
     url(r'^problems/detail$', DetailView.as_view()),
+    url(r'^problems/inventory$', InventoryView.as_view()),
+    url(r'^cache/stats$', CacheStatsView.as_view()),
+    url(r'^batch$', BatchView.as_view()),
 ]
 
 urlpatterns += router.urls
@@ -4,4 +4,7 @@ SECTION_ID_INVALID = 20003
 PROBLEM_ID_INVALID = 20004
 PROBLEM_ID_NOT_EXIST = 20005
 BLOCK_KEY_INVALID = 20006
-BLOCK_ID_REQUIRED = 20007
\ No newline at end of file
+BLOCK_ID_REQUIRED = 20007
+CURSOR_INVALID = 20008
+INVENTORY_NOT_READY = 20009
+BATCH_INVALID = 20010
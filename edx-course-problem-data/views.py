@@ -1,14 +1,26 @@
 # -*- coding:utf-8 -*-
 from __future__ import unicode_literals
 
+import io
+import json
 import logging
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
+import six
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import connections
+from django.utils.http import urlencode
 from django.utils.translation import ugettext as _
 from openedx.core.djangoapps.content.course_overviews.models import CourseOverview
 from openedx.core.lib.api.authentication import OAuth2AuthenticationAllowInactiveUser
 
 from rest_framework import status
+from rest_framework.permissions import IsAdminUser
+from rest_framework.renderers import BrowsableAPIRenderer
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.viewsets import GenericViewSet
@@ -18,16 +30,42 @@ from rest_framework import filters, status
 from xmodule.modulestore.mongo.draft import DraftModuleStore
 
 import util_code
-from .models import BlockStructure
-from .pagination import BlockNumberPagination
-from .exceptions import GetItemError
-from .parser import ProblemParser
+from . import cache, inventory, snapshot
+from .models import (
+    BlockStructure, ProblemArchive, get_problem_definition, get_structure_version, propagate_scope, release_runtimes,
+    request_scope
+)
+from .pagination import BlockNumberPagination, BlockCursorPagination, UserCursorPagination
+from .exceptions import GetItemError, InvalidCursorError
+from .parser import ProblemParser, is_content_cached, parse_fields, select_fields
+from .profiling import PROFILE_HEADER, PROFILE_QUERY_PARAM, ProfileMixin, propagate
+from .renderers import ProblemJSONRenderer
 from .serializers import UserSerializer
 
 log = logging.getLogger("exam.api")
 
+_detail_pool = None
+_detail_pool_lock = threading.Lock()
 
-class CourseView(APIView):
+
+def get_detail_pool():
+    """
+    Threads loading the problems of different courses for DetailView, created
+    on first use so that each gunicorn worker gets its own; None when disabled.
+    """
+    global _detail_pool
+
+    size = getattr(settings, 'PROBLEM_DATA_DETAIL_CONCURRENCY', 4)
+    if not size or size <= 1:
+        return None
+
+    with _detail_pool_lock:
+        if _detail_pool is None:
+            _detail_pool = ThreadPool(size)
+    return _detail_pool
+
+
+class CourseView(ProfileMixin, APIView):
     """
     - 课程列表接口
         * 搜索，按「课程标题」搜索
@@ -57,7 +95,7 @@ class CourseView(APIView):
         return Response(represent, status=status.HTTP_200_OK)
 
 
-class SectionView(APIView):
+class SectionView(ProfileMixin, APIView):
     """
     - 课程章节列表接口
         * 筛选，有题目的章节
@@ -67,23 +105,18 @@ class SectionView(APIView):
 
     def has_problem(self, xblock):
         structure = BlockStructure(xblock.scope_ids.usage_id._to_string())
-        xblocks = structure.get_xblocks()
-        results = filter(lambda x: x.scope_ids.block_type == "problem", xblocks)
+        problems = structure.get_problem_index()
 
-        return len(results) > 0
+        return len(problems) > 0
 
     def count(self, xblock_id):
         structure = BlockStructure(xblock_id)
-        xblocks = structure.get_xblocks()
-        xblocks = filter(lambda x: x.scope_ids.block_type == 'problem', xblocks)
+        problems = structure.get_problem_index()
 
         result = {}
         types_list = ["multiplechoiceresponse", "choiceresponse", "stringresponse"]
         for ptype in types_list:
-            s = set()
-            s.add(ptype)
-
-            filter_problems = filter(lambda x: hasattr(x, 'problem_types') and x.problem_types == s, xblocks)
+            filter_problems = filter(lambda x: x['problem_types'] == [ptype], problems)
             count = len(filter_problems)
             temp = {}
             temp[ptype] = count
@@ -133,7 +166,7 @@ class SectionView(APIView):
             return Response(data, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
-class SectionProblemView(APIView):
+class SectionProblemView(ProfileMixin, APIView):
     """
     - 章节题目列表
     """
@@ -143,19 +176,14 @@ class SectionProblemView(APIView):
     def get_problem(self, section):
 
         structure = BlockStructure(section)
-        xblocks = structure.get_xblocks()
-        xblocks = filter(
-            lambda x: x.scope_ids.block_type == 'problem', xblocks)
+        index = structure.get_problem_index()
 
         problems = dict()
         problems[section] = {}
 
         for ptype in self.types:
-            s = set()
-            s.add(ptype)
-
-            result = filter(lambda x: hasattr(x, 'problem_types') and x.problem_types == s, xblocks)
-            id_list = [xblock.scope_ids.usage_id._to_string() for xblock in result]
+            result = filter(lambda x: x['problem_types'] == [ptype], index)
+            id_list = [x['id'] for x in result]
 
             data = {}
             data[ptype] = id_list
@@ -195,7 +223,7 @@ class SectionProblemView(APIView):
             return Response(data, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
-class SectionCountView(APIView):
+class SectionCountView(ProfileMixin, APIView):
     """
     章节各题型的题目数量
     """
@@ -204,16 +232,12 @@ class SectionCountView(APIView):
 
     def count(self, section_id):
         structure = BlockStructure(section_id)
-        xblocks = structure.get_xblocks()
-        xblocks = filter(lambda x: x.scope_ids.block_type == 'problem', xblocks)
+        problems = structure.get_problem_index()
 
         result = {}
         types_list = ["multiplechoiceresponse", "choiceresponse", "stringresponse"]
         for ptype in types_list:
-            s = set()
-            s.add(ptype)
-
-            filter_problems = filter(lambda x: hasattr(x, 'problem_types') and x.problem_types == s, xblocks)
+            filter_problems = filter(lambda x: x['problem_types'] == [ptype], problems)
             count = len(filter_problems)
             temp = {}
             temp[ptype] = count
@@ -251,7 +275,7 @@ class SectionCountView(APIView):
             return Response(data, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
-class TypeView(APIView):
+class TypeView(ProfileMixin, APIView):
     """
     - 题目类型列表接口
     """
@@ -268,10 +292,12 @@ class TypeView(APIView):
         return Response(type_list)
 
 
-class ProblemView(APIView):
+class ProblemView(ProfileMixin, APIView):
     pagination_class = BlockNumberPagination
+    cursor_pagination_class = BlockCursorPagination
 
     authentication_classes = (OAuth2AuthenticationAllowInactiveUser,)
+    renderer_classes = (ProblemJSONRenderer, BrowsableAPIRenderer)
 
     @property
     def paginator(self):
@@ -300,6 +326,12 @@ class ProblemView(APIView):
         assert self.paginator is not None
         return self.paginator.get_paginated_response(data)
 
+    @property
+    def cursor_paginator(self):
+        if not hasattr(self, '_cursor_paginator'):
+            self._cursor_paginator = self.cursor_pagination_class()
+        return self._cursor_paginator
+
     def get_problem_ids_by_search_text(self, text):
         from xmodule.modulestore.django import modulestore
         store = modulestore()
@@ -317,20 +349,87 @@ class ProblemView(APIView):
         return None
 
     def to_represent(self, xblock):
-        data = ProblemParser(xblock).get_content()
+        data = ProblemParser(xblock, self.fields).get_content()
         # for e in data:
         #     self.result.append(e)
         self.result.append(data)
 
+    def filter_index(self, structure, problem_type, search_text, start=0):
+        """
+        Yield (position, index entry) for each problem to be shown, in the stable
+        order of `BlockStructure.get_problem_index`, starting at position `start`.
+        Only block metadata is used, no problem is parsed.
+        """
+        # 允许展示的题目类型
+        allowed_type = set(
+            ['stringresponse', 'multiplechoiceresponse', 'choiceresponse'])
+
+        # 匹配 text
+        search_problem_ids = None
+        if search_text is not None:
+            search_problem_ids = self.get_problem_ids_by_search_text(search_text)
+            if search_problem_ids is None:
+                return
+            search_problem_ids = set(six.text_type(x) for x in search_problem_ids)
+
+        index = structure.get_problem_index()
+
+        for position in range(start, len(index)):
+            problem = index[position]
+            types = set(problem['problem_types'])
+
+            # 按题型过滤
+            if problem_type is not None and types != set([problem_type]):
+                continue
+            if types & allowed_type == set():
+                continue
+            if search_problem_ids is not None and problem['def_id'] not in search_problem_ids:
+                continue
+
+            # 过滤多重题目的xblock
+            if problem['multi']:
+                continue
+
+            yield position, problem
+
+    def get_problem_xblocks(self, structure, problems):
+        """
+        xblocks of the index entries `problems`, e.g. one page. Only their
+        definitions are prefetched, in one query, and only when some problem
+        isn't already parsed in a cache or snapshot.
+        """
+        if not problems:
+            return []
+
+        snap = snapshot.get_xblock_snapshot(structure.xblock)
+        prefetch = not all(
+            'version' in problem and is_content_cached(problem['id'], problem['version'], self.fields, snap)
+            for problem in problems
+        )
+        return structure.get_problem_xblocks([problem['id'] for problem in problems], prefetch)
+
+    def get_facets(self, structure, problem_type, search_text):
+        """
+        Number of matching problems of each type.
+        """
+        facets = dict((ptype, 0) for ptype in ['multiplechoiceresponse', 'choiceresponse', 'stringresponse'])
+        for position, problem in self.filter_index(structure, problem_type, search_text):
+            # 非多重题目只有一种题型
+            facets[problem['problem_types'][0]] += 1
+        facets['total'] = sum(facets.values())
+        return facets
+
     def get(self, request, *args, **kwargs):
 
         block_id = request.query_params.get('block_id', None)
         problem_type = request.query_params.get('problem_type', None)
         search_text = request.query_params.get('text', None)
 
+        # 只计算需要的字段，例如 fields=id,type,title
+        self.fields = parse_fields(request.query_params.get('fields', None))
+
         try:
             structure = BlockStructure(block_id)
-            xblocks = structure.get_xblocks()
         except GetItemError as ex:
             log.error(ex)
             data = {
@@ -339,70 +438,164 @@ class ProblemView(APIView):
             }
             return Response(data, status=status.HTTP_400_BAD_REQUEST)
 
-        # 按题型过滤
-        # 只有题目才有 problem_types
-        if problem_type is not None:
-            s = set()
-            s.add(problem_type)
-            xblocks = filter(lambda x: hasattr(x, 'problem_types')
-                                       and x.problem_types == s, xblocks)
-
-        # 允许展示的题目类型
-        allowed_type = set(
-            ['stringresponse', 'multiplechoiceresponse', 'choiceresponse'])
-        xblocks = filter(lambda x: hasattr(x, 'problem_types')
-                                   and x.problem_types & allowed_type != set(), xblocks)
-
-        # 只返回题目
-        problems = filter(lambda x: x.scope_ids.block_type ==
-                                    'problem', xblocks)
-
-        # 匹配 text
-        if search_text is not None:
-            search_problem_ids = self.get_problem_ids_by_search_text(
-                search_text)
-            if search_problem_ids is not None:
-                problems = filter(
-                    lambda x: x.scope_ids.def_id in search_problem_ids, problems)
-            else:
-                problems = []
+        # 只返回各题型的数量，不解析题目
+        if request.query_params.get('facets', None) in ('1', 'true'):
+            return Response(self.get_facets(structure, problem_type, search_text))
 
-        # 排序
-        reversed(problems)
+        # 游标分页，从上一页结束的位置继续
+        if self.cursor_paginator.cursor_query_param in request.query_params:
+            return self.get_cursor_page(request, structure, problem_type, search_text)
 
-        # 过滤多重题目的xblock
-        problems = filter(
-            lambda x: ProblemParser.has_multi_problem(x) is False, problems)
+        problems = [problem for position, problem in self.filter_index(structure, problem_type, search_text)]
 
         # 分页
         page = self.paginate_queryset(problems)
         if page is not None:
             self.result = []
-            map(self.to_represent, page)
+            map(self.to_represent, self.get_problem_xblocks(structure, page))
             return self.get_paginated_response(self.result)
         else:
             self.result = []
-            map(self.to_represent, problems)
+            map(self.to_represent, self.get_problem_xblocks(structure, problems))
             return Response(self.result)
 
+    def get_cursor_page(self, request, structure, problem_type, search_text):
+        paginator = self.cursor_paginator
+        version = get_structure_version(structure.xblock)
+
+        try:
+            start = paginator.decode_cursor(request, version)
+        except InvalidCursorError:
+            data = {
+                'msg': _("Cursor is invalid."),
+                'code': util_code.CURSOR_INVALID
+            }
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        rows = self.filter_index(structure, problem_type, search_text, start)
+        page = paginator.paginate_rows(rows, request, version)
+
+        self.result = []
+        map(self.to_represent, self.get_problem_xblocks(structure, page))
+        return paginator.get_paginated_response(self.result)
 
-class DetailView(APIView):
+
+class DetailView(ProfileMixin, APIView):
     authentication_classes = (OAuth2AuthenticationAllowInactiveUser,)
+    renderer_classes = (ProblemJSONRenderer, BrowsableAPIRenderer)
+
+    def get_pinned_key(self, problem):
+        """
+        (usage id, definition version) of a problem pinned to a version, or None.
+        """
+        if isinstance(problem, dict) and problem.get('version', ''):
+            return six.text_type(problem.get('id', '')), six.text_type(problem['version'])
+        return None
+
+    def get_pinned_xblock(self, block_id, version):
+        """
+        题目在定义版本 version（解析结果中的 version）时的内容：
+        发布版本仍是该定义时直接使用发布的 block，否则加载该题目的这个版本的定义；
+        兼容以前按 structure 版本指定的请求
+        """
+        try:
+            xblock = BlockStructure(block_id).xblock
+        except GetItemError:
+            xblock = None
+        if xblock is not None:
+            published_version = six.text_type(xblock.definition_locator.definition_id)
+            if published_version == version:
+                return xblock
+
+            definition = get_problem_definition(block_id, version, published_version)
+            if definition is not None:
+                return definition
+        return BlockStructure(block_id, version).xblock
 
     def get_content(self, problem):
+        key = self.get_pinned_key(problem)
+        if key is not None:
+            xblock = self.get_pinned_xblock(*key)
+
+            # 以前按 structure 版本指定的请求，换成实际的定义版本再读取归档
+            definition_key = (key[0], six.text_type(xblock.definition_locator.definition_id))
+            if definition_key != key:
+                archived = ProblemArchive.get_contents([definition_key])
+                if definition_key in archived:
+                    return select_fields(archived[definition_key], self.fields)
+
+            parser = ProblemParser(xblock)
+            data = parser.get_content()
+
+            # 定义版本不会再变化，完整的解析结果按定义版本归档
+            if parser.version == definition_key[1]:
+                ProblemArchive.archive(definition_key[0], definition_key[1], data)
+            return select_fields(data, self.fields)
+
         if isinstance(problem, dict):
-            block_id = problem.get('id', '')
-            version = problem.get('version', '')
-            xblock = BlockStructure(block_id, version).xblock
+            xblock = BlockStructure(problem.get('id', '')).xblock
         else:
             xblock = BlockStructure(problem).xblock
-        data = ProblemParser(xblock).get_content()
+        data = ProblemParser(xblock, self.fields).get_content()
         return data
 
+    def get_group_key(self, problem):
+        """
+        (course, version) of a problem, its course is the part of the id before the block type.
+        """
+        if isinstance(problem, dict):
+            block_id = problem.get('id', '')
+            version = problem.get('version', '')
+        else:
+            block_id, version = problem, ''
+        return six.text_type(block_id).split('+type@', 1)[0], six.text_type(version or '')
+
+    def get_contents(self, problem_list):
+        """
+        指定版本的题目先从归档中读取（一次查询），其余题目按 (课程, 版本) 分组，
+        不同组的题目并发加载，同一组内顺序加载以共用课程的缓存，结果保持请求的顺序
+        """
+        archived = ProblemArchive.get_contents(
+            key for key in map(self.get_pinned_key, problem_list) if key is not None
+        )
+
+        results = [None] * len(problem_list)
+        groups = OrderedDict()
+        for position, problem in enumerate(problem_list):
+            key = self.get_pinned_key(problem)
+            if key in archived:
+                results[position] = select_fields(archived[key], self.fields)
+            else:
+                groups.setdefault(self.get_group_key(problem), []).append((position, problem))
+
+        def resolve(group):
+            return [(position, self.get_content(problem)) for position, problem in group]
+
+        def resolve_in_thread(group):
+            try:
+                return resolve(group)
+            finally:
+                # 线程池的线程不经过请求中间件，自己释放 runtime 和数据库连接
+                release_runtimes()
+                connections.close_all()
+
+        pool = get_detail_pool()
+        if pool is None or len(groups) <= 1:
+            resolved = map(resolve, groups.values())
+        else:
+            resolved = pool.map(propagate_scope(propagate(resolve_in_thread)), groups.values(), chunksize=1)
+
+        for group in resolved:
+            for position, data in group:
+                results[position] = data
+        return results
+
     def post(self, request, *args, **kwargs):
+        self.fields = parse_fields(request.data.get('fields', request.query_params.get('fields', None)))
+
         try:
             problem_list = request.data.get('problems', [])
-            results = map(self.get_content, problem_list)
+            results = self.get_contents(problem_list)
             return Response(results)
 
         except GetItemError as ex:
@@ -421,9 +614,146 @@ class DetailView(APIView):
             return Response(data, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
-class UserViewSet(ListModelMixin, GenericViewSet):
+class InventoryView(ProfileMixin, APIView):
+    """
+    - 全部在开课程及其章节的各题型题目数量
+        * 由 build_problem_inventory 命令预先生成，返回生成时间 generated_at
+    """
+
+    authentication_classes = (OAuth2AuthenticationAllowInactiveUser,)
+
+    def get(self, request, *args, **kwargs):
+        data = inventory.load_inventory()
+        if data is None:
+            data = {
+                'msg': _("Problem inventory is not ready."),
+                'code': util_code.INVENTORY_NOT_READY
+            }
+            return Response(data, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return Response(data)
+
+
+class CacheStatsView(ProfileMixin, APIView):
+    """
+    - 缓存命中率（监控用）
+    """
+
+    authentication_classes = (OAuth2AuthenticationAllowInactiveUser,)
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request, *args, **kwargs):
+        return Response(cache.stats())
+
+
+# 可以批量查询的接口，path -> (method, view)
+BATCH_VIEWS = {
+    'courses': ('GET', CourseView.as_view()),
+    'sections': ('GET', SectionView.as_view()),
+    'sections/count': ('POST', SectionCountView.as_view()),
+    'section/problems': ('POST', SectionProblemView.as_view()),
+    'problem/types': ('GET', TypeView.as_view()),
+    'problems': ('GET', ProblemView.as_view()),
+    'problems/detail': ('POST', DetailView.as_view()),
+    'problems/inventory': ('GET', InventoryView.as_view()),
+}
+
+
+class BatchView(ProfileMixin, APIView):
+    """
+    - 批量查询接口，组卷页面加载时一次请求完成多个接口的查询
+        * 子查询按顺序执行，共用同一次课程加载和请求内的缓存
+        * 按子查询的 id 返回各自的 status 和 data
+
+    请求格式：
+
+        {"queries": [
+            {"id": "chapters", "path": "sections", "params": {"course_id": "..."}},
+            {"id": "counts", "path": "sections/count", "data": {"section_id": ["..."]}}
+        ]}
+    """
+
+    authentication_classes = (OAuth2AuthenticationAllowInactiveUser,)
+    renderer_classes = (ProblemJSONRenderer, BrowsableAPIRenderer)
+
+    def is_valid_query(self, query):
+        return (
+            isinstance(query, dict) and
+            isinstance(query.get('id', None), six.string_types) and
+            query.get('path', None) in BATCH_VIEWS and
+            isinstance(query.get('params', {}), dict) and
+            isinstance(query.get('data', {}), dict)
+        )
+
+    def build_request(self, request, method, path, params, data):
+        """
+        WSGI request of a sub-query, authenticated as the user of the batch request.
+        """
+        params = dict(params)
+        params.pop(PROFILE_QUERY_PARAM, None)
+        body = json.dumps(data).encode('utf-8') if method == 'POST' else b''
+
+        environ = dict(request.META)
+        # 子查询不单独 profile，计入整个批量请求
+        environ.pop(PROFILE_HEADER, None)
+        environ.update({
+            'REQUEST_METHOD': method,
+            'PATH_INFO': request.path_info.rsplit('/', 1)[0] + '/' + path,
+            'QUERY_STRING': urlencode(params, doseq=True),
+            'CONTENT_TYPE': 'application/json',
+            'CONTENT_LENGTH': str(len(body)),
+            'HTTP_ACCEPT': 'application/json',
+            'wsgi.input': io.BytesIO(body),
+        })
+
+        sub_request = WSGIRequest(environ)
+        sub_request.user = request.user
+        sub_request._force_auth_user = request.user
+        sub_request._force_auth_token = request.auth
+        return sub_request
+
+    def run_query(self, request, query):
+        method, view = BATCH_VIEWS[query['path']]
+        sub_request = self.build_request(
+            request, method, query['path'], query.get('params', {}), query.get('data', {})
+        )
+
+        try:
+            response = view(sub_request)
+        except Exception as ex:
+            log.error(ex)
+            return {'status': status.HTTP_500_INTERNAL_SERVER_ERROR, 'data': {'msg': _("Server Error")}}
+
+        return {'status': response.status_code, 'data': response.data}
+
+    def post(self, request, *args, **kwargs):
+        queries = request.data.get('queries', None)
+        max_queries = getattr(settings, 'PROBLEM_DATA_BATCH_MAX_QUERIES', 20)
+
+        if not isinstance(queries, list) or len(queries) > max_queries or \
+                not all(self.is_valid_query(query) for query in queries):
+            data = {
+                'msg': _("Batch queries are invalid."),
+                'code': util_code.BATCH_INVALID
+            }
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+
+        results = {}
+        with request_scope():
+            for query in queries:
+                results[query['id']] = self.run_query(request, query)
+
+        return Response(results)
+
+
+class UserViewSet(ProfileMixin, ListModelMixin, GenericViewSet):
+    """
+    - 用户列表接口
+        * 搜索，按 username / email 前缀匹配，可以走索引
+        * 游标分页，不做 COUNT(*)
+    """
     authentication_classes = (OAuth2AuthenticationAllowInactiveUser,)
     serializer_class = UserSerializer
-    queryset = get_user_model().objects.all()
+    pagination_class = UserCursorPagination
+    queryset = get_user_model().objects.only('id', 'username', 'email')
     filter_backends = (filters.SearchFilter,)
-    search_fields = ('username', 'email')
+    search_fields = ('^username', '^email')
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+"""
+Load test for the app's endpoints.
+
+Starts gunicorn with several workers serving the app's URLconf against the
+stub modulestore, drives a weighted mix of requests at a fixed concurrency,
+and reports throughput, p50 / p99 latency per endpoint and per-worker RSS.
+Run it from the repository root inside an edx-platform virtualenv:
+
+    python -m loadtest.run --workers 4 --concurrency 32 --duration 60 \\
+        --mix courses=1,sections=2,problems=4,detail=3
+"""
+from __future__ import division, print_function, unicode_literals
+
+import argparse
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from loadtest.stub_modulestore import course_layout
+
+try:
+    from urllib.error import HTTPError
+    from urllib.parse import urlencode
+    from urllib.request import Request, urlopen
+except ImportError:  # Python 2
+    from urllib import urlencode
+    from urllib2 import HTTPError, Request, urlopen
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SEARCH_WORDS = ['planet', 'prime', 'gold', 'question', 'Explanation']
+
+
+class Workload(object):
+    """
+    Builds random requests for each endpoint of the mix.
+    """
+
+    def __init__(self, layouts, detail_batch):
+        self.layouts = layouts
+        self.detail_batch = detail_batch
+        self.sections = [s for l in layouts for c in l['chapters'] for s in c['sections']]
+        self.problems = [p for s in self.sections for p in s['problems']]
+
+    def courses(self):
+        return 'GET', '/exam/courses', None
+
+    def sections_(self):
+        course = random.choice(self.layouts)
+        return 'GET', '/exam/sections?' + urlencode({'course_id': course['id']}), None
+
+    def problems_(self):
+        section = random.choice(self.sections)
+        query = {'block_id': section['id'], 'text': random.choice(SEARCH_WORDS), 'page': 1}
+        return 'GET', '/exam/problems?' + urlencode(query), None
+
+    def detail(self):
+        problems = random.sample(self.problems, min(self.detail_batch, len(self.problems)))
+        return 'POST', '/exam/problems/detail', {'problems': problems}
+
+    def batch(self):
+        # exam builder page load
+        course = random.choice(self.layouts)
+        chapter = random.choice(course['chapters'])
+        section = random.choice(chapter['sections'])
+        queries = [
+            {'id': 'courses', 'path': 'courses'},
+            {'id': 'sections', 'path': 'sections', 'params': {'course_id': course['id']}},
+            {'id': 'counts', 'path': 'sections/count', 'data': {'section_id': [s['id'] for s in chapter['sections']]}},
+            {'id': 'types', 'path': 'problem/types'},
+            {'id': 'problems', 'path': 'problems', 'params': {'block_id': section['id'], 'page': 1}},
+        ]
+        return 'POST', '/exam/batch', {'queries': queries}
+
+    def build(self, name):
+        return {
+            'courses': self.courses,
+            'sections': self.sections_,
+            'problems': self.problems_,
+            'detail': self.detail,
+            'batch': self.batch,
+        }[name]()
+
+
+def parse_mix(value):
+    mix = []
+    for item in value.split(','):
+        name, weight = item.split('=')
+        mix.append((name.strip(), float(weight)))
+    return mix
+
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def read_rss_kb(pid):
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+def child_pids(parent):
+    pids = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(name)) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except IOError:
+            continue
+        if int(fields[1]) == parent:
+            pids.append(int(name))
+    return pids
+
+
+class RSSSampler(threading.Thread):
+    """
+    Samples the RSS of every gunicorn worker, keeping the peak per pid.
+    """
+
+    def __init__(self, master_pid, interval=0.5):
+        super(RSSSampler, self).__init__()
+        self.daemon = True
+        self.master_pid = master_pid
+        self.interval = interval
+        self.peak = {}
+        self.last = {}
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            for pid in child_pids(self.master_pid):
+                rss = read_rss_kb(pid)
+                if rss is not None:
+                    self.last[pid] = rss
+                    self.peak[pid] = max(rss, self.peak.get(pid, 0))
+            self.stopped.wait(self.interval)
+
+
+def start_server(args):
+    env = dict(os.environ)
+    env.update({
+        'PYTHONPATH': os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')])),
+        'LOADTEST_COURSES': ','.join(args.course_ids),
+        'LOADTEST_CHAPTERS': str(args.chapters),
+        'LOADTEST_SECTIONS': str(args.sections),
+        'LOADTEST_PROBLEMS': str(args.problems),
+        'LOADTEST_STORE_LATENCY': str(args.store_latency / 1000),
+    })
+    if args.settings:
+        env['LOADTEST_SETTINGS'] = args.settings
+    else:
+        subprocess.check_call(
+            [sys.executable, '-c', 'import django; django.setup(); '
+                                   'from django.core.management import call_command; '
+                                   'call_command("migrate", verbosity=0, interactive=False)'],
+            env=dict(env, DJANGO_SETTINGS_MODULE='loadtest.settings'), cwd=ROOT
+        )
+
+    command = [
+        sys.executable, '-m', 'gunicorn.app.wsgiapp',
+        '--workers', str(args.workers),
+        '--bind', '127.0.0.1:{}'.format(args.port),
+        '--timeout', '120',
+        '--log-level', 'warning',
+        'loadtest.wsgi:application',
+    ]
+    return subprocess.Popen(command, env=env, cwd=ROOT)
+
+
+def wait_ready(base_url, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urlopen(base_url + '/exam/problem/types', timeout=5).read()
+            return
+        except HTTPError:
+            return
+        except Exception:  # pylint: disable=broad-except
+            time.sleep(0.5)
+    raise RuntimeError('server did not start within {}s'.format(timeout))
+
+
+def send(base_url, method, path, body):
+    data = None
+    headers = {'Accept': 'application/json', 'Accept-Encoding': 'identity'}
+    if body is not None:
+        data = json.dumps(body).encode('utf-8')
+        headers['Content-Type'] = 'application/json'
+    request = Request(base_url + path, data=data, headers=headers)
+    request.get_method = lambda: method
+    try:
+        response = urlopen(request, timeout=120)
+        response.read()
+        return response.getcode()
+    except HTTPError as ex:
+        ex.read()
+        return ex.code
+
+
+def drive(args, workload, mix):
+    names = [name for name, _ in mix]
+    weights = [weight for _, weight in mix]
+    total_weight = sum(weights)
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    lock = threading.Lock()
+    deadline = time.time() + args.duration
+
+    def pick():
+        r = random.uniform(0, total_weight)
+        for name, weight in zip(names, weights):
+            r -= weight
+            if r <= 0:
+                return name
+        return names[-1]
+
+    def client():
+        while time.time() < deadline:
+            name = pick()
+            method, path, body = workload.build(name)
+            start = time.time()
+            try:
+                code = send(args.base_url, method, path, body)
+            except Exception:  # pylint: disable=broad-except
+                code = None
+            elapsed = (time.time() - start) * 1000
+            with lock:
+                latencies[name].append(elapsed)
+                if code is None or code >= 400:
+                    errors[name] += 1
+
+    threads = [threading.Thread(target=client) for _ in range(args.concurrency)]
+    started = time.time()
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, errors, time.time() - started
+
+
+def report(latencies, errors, elapsed, sampler):
+    result = {'elapsed': elapsed, 'endpoints': {}, 'workers': {}}
+    total = 0
+    for name in sorted(latencies):
+        values = latencies[name]
+        total += len(values)
+        result['endpoints'][name] = {
+            'requests': len(values),
+            'errors': errors[name],
+            'rps': len(values) / elapsed,
+            'p50_ms': percentile(values, 50),
+            'p99_ms': percentile(values, 99),
+        }
+    result['rps'] = total / elapsed
+    if sampler is not None:
+        for pid in sorted(sampler.peak):
+            result['workers'][pid] = {'rss_kb': sampler.last[pid], 'peak_rss_kb': sampler.peak[pid]}
+    return result
+
+
+def print_report(result):
+    print('{:<10} {:>9} {:>7} {:>9} {:>10} {:>10}'.format('endpoint', 'requests', 'errors', 'rps', 'p50 ms', 'p99 ms'))
+    for name, row in sorted(result['endpoints'].items()):
+        print('{:<10} {:>9} {:>7} {:>9.1f} {:>10.1f} {:>10.1f}'.format(
+            name, row['requests'], row['errors'], row['rps'], row['p50_ms'], row['p99_ms']))
+    print('total throughput: {:.1f} req/s over {:.1f}s'.format(result['rps'], result['elapsed']))
+    for pid, row in sorted(result['workers'].items()):
+        print('worker {:>7}: rss {:>8} kB, peak {:>8} kB'.format(pid, row['rss_kb'], row['peak_rss_kb']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent clients')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to drive load')
+    parser.add_argument('--mix', default='courses=1,sections=2,problems=4,detail=3',
+                        help='endpoint weights, from courses, sections, problems, detail and batch')
+    parser.add_argument('--courses', type=int, default=3, help='fixture courses')
+    parser.add_argument('--chapters', type=int, default=4, help='chapters per course')
+    parser.add_argument('--sections', type=int, default=5, help='sections per chapter')
+    parser.add_argument('--problems', type=int, default=20, help='problems per section')
+    parser.add_argument('--detail-batch', type=int, default=20, help='problems per problems/detail request')
+    parser.add_argument('--store-latency', type=float, default=5, help='stub modulestore latency per get_item, ms')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--settings', default=None, help='Django settings module, default loadtest.settings')
+    parser.add_argument('--base-url', default=None, help='drive an already running server instead')
+    parser.add_argument('--json', dest='json_path', default=None, help='also write the report to this file')
+    args = parser.parse_args()
+
+    args.course_ids = ['course-v1:LoadTest+LT{}+2026'.format(i) for i in range(args.courses)]
+    layouts = [course_layout(c, args.chapters, args.sections, args.problems) for c in args.course_ids]
+    workload = Workload(layouts, args.detail_batch)
+
+    server = None
+    sampler = None
+    if args.base_url is None:
+        args.base_url = 'http://127.0.0.1:{}'.format(args.port)
+        server = start_server(args)
+    try:
+        wait_ready(args.base_url)
+        if server is not None:
+            sampler = RSSSampler(server.pid)
+            sampler.start()
+        latencies, errors, elapsed = drive(args, workload, parse_mix(args.mix))
+        if sampler is not None:
+            sampler.stopped.set()
+            sampler.join()
+    finally:
+        if server is not None:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+
+    result = report(latencies, errors, elapsed, sampler)
+    print_report(result)
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
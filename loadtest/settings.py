@@ -0,0 +1,41 @@
+"""
+Minimal Django settings for the load-test harness.
+
+Runs the app's URLconf under `/exam/` against the stub modulestore. Set
+LOADTEST_SETTINGS to an edx-platform settings module (e.g.
+cms.envs.devstack) to run against a full platform configuration instead.
+"""
+import os
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SECRET_KEY = 'loadtest'
+DEBUG = False
+ALLOWED_HOSTS = ['*']
+
+INSTALLED_APPS = [
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'rest_framework',
+    'openedx.core.djangoapps.content.course_overviews',
+    'edx-course-problem-data',
+]
+
+MIDDLEWARE_CLASSES = []
+
+ROOT_URLCONF = 'loadtest.urls'
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get('LOADTEST_DB', os.path.join(BASE_DIR, 'loadtest.sqlite3')),
+    }
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+USE_TZ = True
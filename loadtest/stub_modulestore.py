@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Stub modulestore serving generated fixture courses.
+
+Each course has `chapters` chapters of `sections` sequentials, each holding
+`problems` problems built from the templates in fixtures/problems. Block ids
+are deterministic, so the load driver can compute them with `course_layout`
+without importing edx-platform.
+
+`install` replaces `xmodule.modulestore.django.modulestore` once Django is set up.
+"""
+from __future__ import unicode_literals
+
+import glob
+import hashlib
+import io
+import os
+import re
+import sys
+import time
+from contextlib import contextmanager
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def object_id(*parts):
+    """
+    Deterministic 24-hex id, usable as a bson ObjectId.
+    """
+    return hashlib.md5('/'.join(parts).encode('utf-8')).hexdigest()[:24]
+
+
+def load_templates():
+    templates = []
+    for path in sorted(glob.glob(os.path.join(FIXTURE_DIR, 'problems', '*.xml'))):
+        with io.open(path, encoding='utf-8') as f:
+            templates.append(f.read())
+    return templates
+
+
+def course_layout(course_id, chapters, sections, problems):
+    """
+    Return the block ids of a fixture course, in the form the app's views take:
+
+        {'id': course_id, 'chapters': [{'id': ..., 'sections': [{'id': ..., 'problems': [...]}]}]}
+    """
+    prefix = course_id.split(':', 1)[1]
+
+    def block_id(block_type, name):
+        return '{}+type@{}+block@{}'.format(prefix, block_type, name)
+
+    layout = {'id': course_id, 'chapters': []}
+    for c in range(chapters):
+        chapter = {'id': block_id('chapter', 'chapter_{}'.format(c)), 'sections': []}
+        for s in range(sections):
+            section = {'id': block_id('sequential', 'sequential_{}_{}'.format(c, s)), 'problems': []}
+            for p in range(problems):
+                section['problems'].append(block_id('problem', 'problem_{}_{}_{}'.format(c, s, p)))
+            chapter['sections'].append(section)
+        layout['chapters'].append(chapter)
+    return layout
+
+
+class StubRuntime(object):
+
+    class CourseEntry(object):
+        def __init__(self, structure_id):
+            self.structure = {'_id': structure_id}
+
+    def __init__(self, structure_id):
+        self.course_entry = StubRuntime.CourseEntry(structure_id)
+
+
+class StubBlock(object):
+
+    def __init__(self, usage_key, display_name, runtime, def_id):
+        from opaque_keys.edx.locator import DefinitionLocator
+        from xblock.fields import ScopeIds
+
+        self.location = usage_key
+        self.scope_ids = ScopeIds(None, usage_key.block_type, def_id, usage_key)
+        self.definition_locator = DefinitionLocator(usage_key.block_type, def_id)
+        self.display_name = display_name
+        self.runtime = runtime
+        self.children = []
+
+    def get_children(self):
+        return list(self.children)
+
+
+class StubProblemBlock(StubBlock):
+
+    def __init__(self, usage_key, display_name, runtime, def_id, data):
+        super(StubProblemBlock, self).__init__(usage_key, display_name, runtime, def_id)
+        self.data = data
+
+    @property
+    def problem_types(self):
+        # same as CapaDescriptor.problem_types: parsed on every access
+        from capa import responsetypes
+        from lxml import etree
+
+        tree = etree.XML(self.data)
+        registered_tags = responsetypes.registry.registered_tags()
+        return {node.tag for node in tree.iter() if node.tag in registered_tags}
+
+
+class StubDefinitions(object):
+    """
+    Answers the `definitions.find({'fields.data': {'$regex': ...}})` query of ProblemView.
+    """
+
+    def __init__(self, definitions):
+        self.definitions = definitions
+
+    def find(self, query, projection=None):
+        pattern = re.compile(query['fields.data']['$regex'])
+        return [{'_id': def_id} for def_id, data in self.definitions.items() if pattern.search(data)]
+
+
+def make_search_store(definitions):
+    from xmodule.modulestore.mongo.draft import DraftModuleStore
+
+    class Namespace(object):
+        def __init__(self, **kwargs):
+            self.__dict__.update(kwargs)
+
+    class StubDraftModuleStore(DraftModuleStore):
+        def __init__(self):  # pylint: disable=super-init-not-called
+            # database.modulestore.definitions
+            self.database = Namespace(modulestore=Namespace(definitions=StubDefinitions(definitions)))
+
+    return StubDraftModuleStore()
+
+
+class StubModuleStore(object):
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.blocks = {}
+        self.definitions = {}
+        self.modulestores = []
+        self.templates = load_templates()
+
+    def add_course(self, course_id, chapters, sections, problems):
+        from bson.objectid import ObjectId
+        from opaque_keys.edx.keys import CourseKey, UsageKey
+
+        course_key = CourseKey.from_string(course_id)
+        runtime = StubRuntime(ObjectId(object_id(course_id, 'structure')))
+
+        def make(block_id, display_name, data=None):
+            usage_key = UsageKey.from_string('block-v1:' + block_id)
+            def_id = ObjectId(object_id(block_id, 'definition'))
+            if data is None:
+                block = StubBlock(usage_key, display_name, runtime, def_id)
+            else:
+                block = StubProblemBlock(usage_key, display_name, runtime, def_id, data)
+                self.definitions[def_id] = data
+            self.blocks[str(usage_key)] = block
+            return block
+
+        layout = course_layout(course_id, chapters, sections, problems)
+        course = make(
+            '{}+type@course+block@course'.format(course_id.split(':', 1)[1]),
+            course_key.course
+        )
+        n = 0
+        for c, chapter_layout in enumerate(layout['chapters']):
+            chapter = make(chapter_layout['id'], 'Chapter {}'.format(c))
+            course.children.append(chapter)
+            for s, section_layout in enumerate(chapter_layout['sections']):
+                section = make(section_layout['id'], 'Section {}.{}'.format(c, s))
+                vertical = make(section_layout['id'].replace('sequential', 'vertical'), 'Unit {}.{}'.format(c, s))
+                chapter.children.append(section)
+                section.children.append(vertical)
+                for problem_id in section_layout['problems']:
+                    template = self.templates[n % len(self.templates)]
+                    vertical.children.append(make(problem_id, 'Problem {}'.format(n), template.replace('$N', str(n))))
+                    n += 1
+
+        self.modulestores = [make_search_store(self.definitions)]
+
+    @contextmanager
+    def bulk_operations(self, course_key):
+        yield
+
+    def get_item(self, usage_key, depth=0, **kwargs):
+        from xmodule.modulestore.exceptions import ItemNotFoundError
+
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            return self.blocks[str(usage_key)]
+        except KeyError:
+            raise ItemNotFoundError(usage_key)
+
+
+def install(courses, chapters, sections, problems, latency=0.0):
+    """
+    Build the fixture courses and make `modulestore()` return the stub, including
+    in modules that already did `from xmodule.modulestore.django import modulestore`.
+    """
+    import xmodule.modulestore.django
+
+    store = StubModuleStore(latency)
+    for course_id in courses:
+        store.add_course(course_id, chapters, sections, problems)
+
+    original = xmodule.modulestore.django.modulestore
+
+    def stub():
+        return store
+
+    for module in list(sys.modules.values()):
+        if module is not None and getattr(module, 'modulestore', None) is original:
+            module.modulestore = stub
+    return store
@@ -0,0 +1,25 @@
+"""
+WSGI entry point of the load-test harness.
+
+The fixture courses are configured through the environment set by run.py:
+LOADTEST_COURSES (comma separated), LOADTEST_CHAPTERS, LOADTEST_SECTIONS,
+LOADTEST_PROBLEMS and LOADTEST_STORE_LATENCY (seconds per get_item).
+"""
+import os
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', os.environ.get('LOADTEST_SETTINGS', 'loadtest.settings'))
+
+from django.core.wsgi import get_wsgi_application  # pylint: disable=wrong-import-position
+
+from loadtest import stub_modulestore  # pylint: disable=wrong-import-position
+
+application = get_wsgi_application()
+
+stub_modulestore.install(
+    os.environ['LOADTEST_COURSES'].split(','),
+    int(os.environ.get('LOADTEST_CHAPTERS', 4)),
+    int(os.environ.get('LOADTEST_SECTIONS', 5)),
+    int(os.environ.get('LOADTEST_PROBLEMS', 20)),
+    float(os.environ.get('LOADTEST_STORE_LATENCY', 0)),
+)
+